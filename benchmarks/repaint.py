@@ -0,0 +1,102 @@
+"""
+Measures how long FrameWriter takes to repaint the whole screen with a
+composited Earth map (topography and grid on, with and without night
+shading), including refresh().
+
+Each size runs in a child process attached to a pseudo terminal of
+that size, so no real terminal is needed:
+
+    python benchmarks/repaint.py [REPEAT]
+"""
+import curses
+from datetime import datetime, timezone
+import fcntl
+import os
+import pty
+import select
+import struct
+import subprocess
+import sys
+import termios
+from time import perf_counter
+
+SIZES = ((200, 60), (400, 120))
+TIME = datetime(2026, 3, 1, 7, 30, tzinfo=timezone.utc)
+
+
+def child(stdscr, night, repeat):
+    from termtrack.body import Earth
+    from termtrack.draw import draw_grid, draw_map
+    from termtrack.layer import ArrayLayer, Compositor, Layer
+    from termtrack.utils.curses import FrameWriter, setup
+
+    setup(stdscr)
+    height, width = stdscr.getmaxyx()
+    body = Earth(width, height)
+    for progress in body.prepare_map():
+        pass
+    map_layer = ArrayLayer(draw_map, inputs=("body",))
+    map_layer.update({'body': body}, body, TIME, night=night, topo=True)
+    grid_layer = Layer(draw_grid, inputs=("body",))
+    grid_layer.update({'body': body}, body)
+    chars, colors = Compositor(
+        [map_layer, grid_layer],
+        static_layers=(map_layer, grid_layer),
+    ).compose(width, height)
+
+    start = perf_counter()
+    for i in range(repeat):
+        # a new FrameWriter has no previous frame to diff against
+        FrameWriter(stdscr).write(chars, colors)
+        stdscr.refresh()
+    return (perf_counter() - start) / repeat
+
+
+def run(width, height, night, repeat):
+    """
+    Runs child() in a pseudo terminal of the given size and returns the
+    average time per repaint in seconds.
+    """
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", height, width, 0, 0))
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--child", "night" if night else "day", str(repeat)],
+        env=dict(os.environ, TERM="xterm-256color"),
+        stderr=subprocess.PIPE,
+        stdin=slave,
+        stdout=slave,
+    )
+    os.close(slave)
+    # keep draining the terminal output so the child never blocks
+    while process.poll() is None:
+        if select.select([master], [], [], 0.05)[0]:
+            try:
+                os.read(master, 1 << 20)
+            except OSError:
+                break
+    process.wait()
+    os.close(master)
+    stderr = process.stderr.read().decode()
+    if process.returncode != 0:
+        raise RuntimeError(stderr)
+    return float(stderr)
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        seconds = curses.wrapper(child, sys.argv[2] == "night", int(sys.argv[3]))
+        sys.stderr.write("{}\n".format(seconds))
+        return
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("size     shading  repaint")
+    for width, height in SIZES:
+        for night in (False, True):
+            print("{:<8} {:<8} {:6.1f} ms".format(
+                "{}x{}".format(width, height),
+                "night" if night else "day",
+                run(width, height, night, repeat) * 1000,
+            ))
+
+
+if __name__ == '__main__':
+    main()
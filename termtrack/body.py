@@ -1,25 +1,118 @@
-from copy import copy
-from os.path import dirname, expanduser, join
-import shelve
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import cached_property
+from multiprocessing import get_all_start_methods, get_context
+from os.path import dirname, join
+from threading import Event, Lock, Thread
+from time import sleep
 
+import numpy as np
 from PIL import Image
-import shapefile
 
-from .utils.curses import closest_color
-from .utils.geometry import latlon_to_spherical, point_in_poly, spherical_to_cartesian
+from .cache import COORDINATE_FIELDS, MapCache
+from .land import load_land_polygons
+from .utils.curses import closest_colors
+from .utils.geometry import latlon_to_spherical_array, spherical_to_cartesian_array
 
 
-MAP_CACHE = "~/.termtrack_map_cache"
+MAP_WORKERS_DEFAULT_MAX = 4
+MASTER_PYRAMID_LEVELS = 3
+PARALLEL_MIN_PIXELS = 500000  # below this, starting the workers takes longer
+TABLE_FIELDS = COORDINATE_FIELDS + ("land", "colors", "rgb")
+
+
+def nearest_indices(size_from, size_to):
+    """
+    Returns the indices of the nearest of size_from pixels for each of
+    size_to pixels spanning the same range.
+    """
+    return np.rint(
+        np.arange(size_to) * ((size_from - 1) / max(size_to - 1, 1))
+    ).astype(np.intp)
+
+
+def pixel_grid(width, height):
+    """
+    Returns the latitudes of all rows and longitudes of all columns of
+    a map with the given dimensions.
+    """
+    lat = 90 - (np.arange(height) / (height - 1)) * 180
+    lon = (np.arange(width) / (width - 1)) * 360 - 180
+    return lat, lon
 
 
 class Body:
+    """
+    A map of a celestial body at a given terminal size. Once
+    prepare_map() has run, the per-pixel data is available as one
+    array per field, each indexed by [x, y]:
+
+        land                whether the pixel shows land
+        colors              terminal color number (land only)
+        rgb                 image color (land only)
+        latitudes,
+        longitudes          geographic coordinates
+        theta, phi          spherical coordinates
+        cartesian_{x,y,z}   Cartesian coordinates on the unit sphere
+
+    Colors are resampled from a master raster that is only decoded
+    once per process, so new sizes are cheap. The land mask is always
+    rasterized at the actual size.
+    """
+    _master_rasters = {}
+
     def __init__(self, width, height):
         self.height = height
+        self.is_preview = False
         self.width = width
-        self.pixel_percentage = 100 / (self.width * self.height)
-        self._img = Image.open(join(dirname(__file__), "data", self.COLORMAP))
-        if self.SHAPEFILE is not None:
-            self._sf = shapefile.Reader(join(dirname(__file__), "data", self.SHAPEFILE))
+
+    @classmethod
+    def master_raster(cls):
+        """
+        Returns a pyramid of the decoded color map, halving its size
+        MASTER_PYRAMID_LEVELS times.
+        """
+        try:
+            return Body._master_rasters[cls.NAME]
+        except KeyError:
+            pass
+        img = Image.open(join(dirname(__file__), "data", cls.COLORMAP)).convert("RGB")
+        pyramid = [img]
+        for level in range(MASTER_PYRAMID_LEVELS):
+            pyramid.append(pyramid[-1].reduce(2))
+        Body._master_rasters[cls.NAME] = pyramid
+        return pyramid
+
+    @classmethod
+    def preview(cls, width, height, source=None, map_cache=None):
+        """
+        Returns a Body with coarse land and colors scaled from source
+        (or the closest size in the map cache) to show while the real
+        map is prepared. Without any source the preview is all ocean.
+        """
+        body = cls(width, height)
+        body.is_preview = True
+        body._build_coordinates()
+
+        if source is None:
+            if map_cache is None:
+                map_cache = MapCache()
+            closest = map_cache.closest(cls.NAME, width, height)
+            if closest is not None:
+                tables = map_cache.load(*closest)
+                if tables is not None:
+                    source = cls(*closest[1:])
+                    source._set_tables(tables)
+
+        if source is None:
+            body.land = np.zeros((width, height), dtype=bool)
+            body.colors = np.zeros((width, height), dtype=np.uint8)
+            body.rgb = np.zeros((width, height, 3), dtype=np.uint8)
+        else:
+            source_x = nearest_indices(source.width, width)[:, None]
+            source_y = nearest_indices(source.height, height)[None, :]
+            for field in ("land", "colors", "rgb"):
+                setattr(body, field, getattr(source, field)[source_x, source_y])
+        return body
 
     def from_latlon(self, lat, lon):
         xrel = (lon + 180) / 360
@@ -28,67 +121,266 @@ class Body:
         y = round((self.height - 1) * yrel)
         return min(x, self.width - 1), min(y, self.height - 1)
 
-    def prepare_map(self):
-        map_cache = shelve.open(expanduser(MAP_CACHE))
-        try:
-            map_cache_key = "{}_{}x{}".format(self.NAME, self.width, self.height)
-            if map_cache_key in map_cache:
-                self.map = map_cache[map_cache_key]
-                return
-            progress = 0.0
-            empty_line = [None for i in range(self.height)]
-            self.map = [copy(empty_line) for i in range(self.width)]
-
-            img = self._img.resize((self.width, self.height))
-            pixels = img.load()
-
-            for x in range(self.width):
-                for y in range(self.height):
-                    yield progress
-                    color = r = g = b = None
-                    lat, lon = self._to_latlon(x, y)
-                    if self.SHAPEFILE is not None:
-                        for shape in self._sf.iterShapes():
-                            if (
-                                # for performance reasons we quickly check the
-                                # bounding box before trying the more expensive
-                                # point_in_poly() call
-                                lat > shape.bbox[1] and
-                                lat < shape.bbox[3] and
-                                lon > shape.bbox[0] and
-                                lon < shape.bbox[2]
-                            ) and point_in_poly(lon, lat, shape.points):
-                                r, g, b = pixels[x, y]
-                                color = closest_color(r, g, b)
-                                break
-                    else:
-                        r, g, b = pixels[x, y]
-                        color = closest_color(r, g, b)
-                    spherical = latlon_to_spherical(lat, lon)
-                    cartesian = spherical_to_cartesian(*spherical)
-                    self.map[x][y] = (r, g, b, color, (lat, lon), spherical, cartesian)
-                    progress += self.pixel_percentage
-                    yield progress
-            map_cache[map_cache_key] = self.map
-        finally:
-            map_cache.close()
+    def prepare_map(self, map_cache=None, workers=1):
+        if map_cache is None:
+            map_cache = MapCache()
+        map_cache_key = "{}_{}x{}".format(self.NAME, self.width, self.height)
+        tables = map_cache.load(map_cache_key, self.width, self.height)
+        if tables is None:
+            build_lock = map_cache.build_lock(map_cache_key)
+            try:
+                while not build_lock.acquire(blocking=False):
+                    # another termtrack process is building the same map,
+                    # wait for its result
+                    yield 0.0
+                    sleep(0.1)
+                # check again in case we just waited for another process
+                tables = map_cache.load(map_cache_key, self.width, self.height)
+                if tables is None:
+                    yield 0.0
+                    for progress in self._build_tables(workers=workers):
+                        yield progress * 0.9
+                    map_cache.store(map_cache_key, self.width, self.height, self._get_tables())
+                    yield 100.0
+                    return
+            finally:
+                build_lock.release()
+        self._set_tables(tables)
 
-    def to_cartesian(self, x, y):
-        return self.map[x][y][6]
+    def _get_tables(self):
+        return {field: getattr(self, field) for field in TABLE_FIELDS}
 
-    def to_latlon(self, x, y):
-        return self.map[x][y][4]
+    def _set_tables(self, tables):
+        for field in TABLE_FIELDS:
+            setattr(self, field, tables[field])
+
+    def _build_coordinates(self):
+        lat, lon = pixel_grid(self.width, self.height)
+        self.latitudes = np.broadcast_to(lat[None, :], (self.width, self.height))
+        self.longitudes = np.broadcast_to(lon[:, None], (self.width, self.height))
+
+        self.theta, self.phi = latlon_to_spherical_array(self.latitudes, self.longitudes)
+        self.cartesian_x, self.cartesian_y, self.cartesian_z = \
+            spherical_to_cartesian_array(self.theta, self.phi)
+
+    def _build_tables(self, workers=1):
+        """
+        Computes land status, color and coordinates for all pixels at
+        once, storing them as arrays indexed by [x, y]. Large maps are
+        split into column stripes prepared by a pool of worker
+        processes that only lives for this build. Yields the percentage
+        of columns done.
+        """
+        self._build_coordinates()
+        if workers > 1 and self.width * self.height >= PARALLEL_MIN_PIXELS:
+            stripe_width = -(-self.width // workers)
+            pool = map_worker_pool(workers)
+            futures = {}
+            try:
+                for x_start in range(0, self.width, stripe_width):
+                    x_end = min(x_start + stripe_width, self.width)
+                    futures[pool.submit(
+                        build_stripe, self.NAME, self.width, self.height, x_start, x_end,
+                    )] = x_start, x_end
+                self.land = np.empty((self.width, self.height), dtype=bool)
+                self.rgb = np.empty((self.width, self.height, 3), dtype=np.uint8)
+                self.colors = np.empty((self.width, self.height), dtype=np.uint8)
+                columns_done = 0
+                for future in as_completed(futures):
+                    x_start, x_end = futures[future]
+                    (
+                        self.land[x_start:x_end],
+                        self.rgb[x_start:x_end],
+                        self.colors[x_start:x_end],
+                    ) = future.result()
+                    columns_done += x_end - x_start
+                    yield 100 * columns_done / self.width
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            self.land, self.rgb, self.colors = self._build_stripe(0, self.width)
+            yield 100.0
+
+    def _build_stripe(self, x_start, x_end):
+        """
+        Returns land, rgb and colors tables for columns x_start to
+        x_end (exclusive).
+        """
+        stripe_width = x_end - x_start
+        if self.SHAPEFILE is None:
+            land = np.ones((stripe_width, self.height), dtype=bool)
+        else:
+            land = rasterize_land(self.SHAPEFILE, self.width, self.height, x_start, x_end)
+
+        # downsample from the smallest image that is still larger than us
+        for img in reversed(self.master_raster()):
+            if img.width >= self.width and img.height >= self.height:
+                break
+        # resizing only the stripe would filter its edges differently,
+        # so resize the whole map to keep stripes identical to a
+        # serial build
+        rgb = np.asarray(
+            img.resize((self.width, self.height))
+        ).transpose(1, 0, 2)[x_start:x_end]
+        colors = np.zeros((stripe_width, self.height), dtype=np.uint8)
+        colors[land] = closest_colors(rgb[land], exact=True)
+        return land, rgb, colors
+
+    def column(self, field, x):
+        """
+        Returns the given table (e.g. "land" or "colors") for all
+        pixels in column x.
+        """
+        return getattr(self, field)[x]
 
-    def _to_latlon(self, x, y):
-        xrel = x / (self.width - 1)
-        yrel = y / (self.height - 1)
+    @cached_property
+    def latlon_trig(self):
+        """
+        Sine and cosine of latitudes and longitudes (in that order).
+        """
+        lat = np.radians(self.latitudes)
+        lon = np.radians(self.longitudes)
+        return np.sin(lat), np.cos(lat), np.sin(lon), np.cos(lon)
+
+    def row(self, field, y):
+        """
+        Returns the given table (e.g. "land" or "colors") for all
+        pixels in row y.
+        """
+        return getattr(self, field)[:, y]
+
+    def to_cartesian(self, x, y):
         return (
-            90 - yrel * 180,
-            xrel * 360 - 180,
+            float(self.cartesian_x[x, y]),
+            float(self.cartesian_y[x, y]),
+            float(self.cartesian_z[x, y]),
         )
 
+    def to_latlon(self, x, y):
+        return float(self.latitudes[x, y]), float(self.longitudes[x, y])
+
     def to_spherical(self, x, y):
-        return self.map[x][y][5]
+        return float(self.theta[x, y]), float(self.phi[x, y])
+
+
+class MapBuilder:
+    """
+    Prepares maps in a background thread. Requests are debounced so
+    that only the last of several quickly repeated requests is
+    actually built, and a build is abandoned once a newer request comes
+    in. on_ready is called from the builder thread after a map has
+    been finished (or failed), which can then be picked up with poll().
+    """
+    def __init__(self, debounce=0.2, on_ready=None, workers=1):
+        self.debounce = debounce
+        self.on_ready = on_ready
+        self.workers = workers
+        self._finished = None
+        self._lock = Lock()
+        self._quit = Event()
+        self._request = None
+        self._wakeup = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def poll(self):
+        """
+        Returns the finished Body or None. Errors raised while
+        preparing the map are raised here.
+        """
+        with self._lock:
+            body, self._finished = self._finished, None
+        if isinstance(body, BaseException):
+            raise body
+        return body
+
+    def request(self, body_class, width, height):
+        with self._lock:
+            self._request = (body_class, width, height)
+            self._finished = None
+        self._wakeup.set()
+
+    def stop(self):
+        self._quit.set()
+        self._wakeup.set()
+        self._thread.join()
+
+    def _current_request(self):
+        with self._lock:
+            return self._request
+
+    def _run(self):
+        while not self._quit.is_set():
+            self._wakeup.wait()
+            # wait for the size to settle
+            while self._wakeup.is_set() and not self._quit.is_set():
+                self._wakeup.clear()
+                sleep(self.debounce)
+            request = self._current_request()
+            if request is None or self._quit.is_set():
+                continue
+
+            body_class, width, height = request
+            body = body_class(width, height)
+            map_preparation = body.prepare_map(workers=self.workers)
+            try:
+                for progress in map_preparation:
+                    if self._quit.is_set() or self._current_request() is not request:
+                        break
+                else:
+                    self._finish(request, body)
+            except Exception as exc:
+                # hand the error to the render thread instead of
+                # silently dying with the builder thread
+                self._finish(request, exc)
+            finally:
+                map_preparation.close()
+
+    def _finish(self, request, result):
+        with self._lock:
+            finished = self._request is request
+            if finished:
+                self._finished = result
+                self._request = None
+        if finished and self.on_ready is not None:
+            self.on_ready()
+
+
+def build_stripe(body_name, width, height, x_start, x_end):
+    """
+    Worker process entry point for Body._build_tables().
+    """
+    return BODY_MAP[body_name.lower()](width, height)._build_stripe(x_start, x_end)
+
+
+def map_worker_pool(workers):
+    """
+    Returns a new process pool for preparing map stripes. Workers are
+    not forked from the current process directly, since it is running
+    other threads (e.g. for input and layers) at that point.
+    """
+    if "forkserver" in get_all_start_methods():
+        mp_context = get_context("forkserver")
+        # workers forked from the server won't have to import us again
+        mp_context.set_forkserver_preload([__name__])
+    else:
+        mp_context = get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+
+
+def rasterize_land(shapefile, width, height, x_start=0, x_end=None):
+    """
+    Returns a boolean land mask indexed by [x, y], optionally only for
+    columns x_start to x_end (exclusive).
+    """
+    if x_end is None:
+        x_end = width
+    polygons = load_land_polygons(join(dirname(__file__), "data", shapefile))
+    lat, lon = pixel_grid(width, height)
+    land = polygons.rasterize(lat.tolist(), lon[x_start:x_end].tolist())
+    return np.frombuffer(b"".join(land), dtype=np.uint8).reshape(
+        height, x_end - x_start,
+    ).T.astype(bool)
 
 
 class Earth(Body):
@@ -0,0 +1,263 @@
+import fcntl
+from mmap import ACCESS_READ, mmap
+from os import (
+    O_CREAT,
+    O_RDWR,
+    close,
+    fdopen,
+    listdir,
+    makedirs,
+    open as os_open,
+    remove,
+    replace,
+    stat,
+    utime,
+)
+from os.path import expanduser, join
+import struct
+from tempfile import mkstemp
+from time import time
+
+import numpy as np
+
+
+MAP_CACHE = "~/.cache/termtrack"
+MAP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+MAP_CACHE_LOCK_SUFFIX = ".lock"
+MAP_CACHE_STALE_SECONDS = 3600
+MAP_CACHE_SUFFIX = ".map"
+MAP_CACHE_TMP_SUFFIX = ".tmp"
+MAP_CACHE_VERSION = 1
+
+HEADER = struct.Struct("<8sHII")
+HEADER_MAGIC = b"TTMAPBIN"
+HEADER_SIZE = 32  # keeps the float32 block aligned
+
+COORDINATE_FIELDS = (
+    "latitudes",
+    "longitudes",
+    "theta",
+    "phi",
+    "cartesian_x",
+    "cartesian_y",
+    "cartesian_z",
+)
+
+
+def cache_file_size(width, height):
+    pixels = width * height
+    # float32 coordinates + land flag + palette color + RGB
+    return HEADER_SIZE + pixels * (4 * len(COORDINATE_FIELDS) + 1 + 1 + 3)
+
+
+class BuildLock:
+    """
+    An exclusive advisory lock held by the process currently building
+    a cache entry, so other processes can wait for its result instead
+    of building the same entry themselves.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        if self._fd is None:
+            self._fd = os_open(self.filename, O_RDWR | O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class MapCache:
+    """
+    Stores the tables computed by Body.prepare_map() in one binary file
+    per body and size. Files consist of a short header followed by
+    fixed-width arrays, so they can be memory-mapped when loading
+    instead of being deserialized. Once the cache grows beyond
+    max_bytes, the least recently used sizes are removed.
+
+    Entries are written to a temporary file and renamed into place, so
+    concurrent readers never see partially written files.
+    """
+    def __init__(self, path=MAP_CACHE, max_bytes=MAP_CACHE_MAX_BYTES):
+        self.path = expanduser(path)
+        self.max_bytes = max_bytes
+
+    def _filename(self, key):
+        return join(self.path, key + MAP_CACHE_SUFFIX)
+
+    def build_lock(self, key):
+        makedirs(self.path, exist_ok=True)
+        return BuildLock(join(self.path, key + MAP_CACHE_LOCK_SUFFIX))
+
+    def closest(self, name, width, height):
+        """
+        Returns (key, width, height) of the cached size for the given
+        body that is closest to the given size, or None.
+        """
+        closest = None
+        closest_distance = None
+        try:
+            filenames = listdir(self.path)
+        except OSError:
+            return None
+        for filename in filenames:
+            if not filename.startswith(name + "_") or not filename.endswith(MAP_CACHE_SUFFIX):
+                continue
+            key = filename[:-len(MAP_CACHE_SUFFIX)]
+            try:
+                cached_width, cached_height = map(int, key[len(name) + 1:].split("x"))
+            except ValueError:
+                continue
+            distance = abs(cached_width - width) + abs(cached_height - height)
+            if closest_distance is None or distance < closest_distance:
+                closest = key, cached_width, cached_height
+                closest_distance = distance
+        return closest
+
+    def load(self, key, width, height):
+        """
+        Returns a dict of arrays indexed by [x, y] or None if there is
+        no valid cache entry.
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except (OSError, ValueError):
+            # ValueError is raised when trying to map an empty file
+            return None
+
+        if len(data) < HEADER.size or len(data) != cache_file_size(width, height):
+            data.close()
+            return None
+        magic, version, cached_width, cached_height = HEADER.unpack_from(data)
+        if (
+            magic != HEADER_MAGIC or
+            version != MAP_CACHE_VERSION or
+            cached_width != width or
+            cached_height != height
+        ):
+            data.close()
+            return None
+
+        # mark as recently used
+        try:
+            utime(filename)
+        except OSError:
+            # evicted by another process in the meantime, but our
+            # mapping remains valid
+            pass
+
+        pixels = width * height
+        tables = {}
+        offset = HEADER_SIZE
+        for field in COORDINATE_FIELDS:
+            tables[field] = np.frombuffer(
+                data, dtype="<f4", count=pixels, offset=offset,
+            ).reshape(width, height)
+            offset += pixels * 4
+        tables['land'] = np.frombuffer(
+            data, dtype=np.uint8, count=pixels, offset=offset,
+        ).reshape(width, height).view(bool)
+        offset += pixels
+        tables['colors'] = np.frombuffer(
+            data, dtype=np.uint8, count=pixels, offset=offset,
+        ).reshape(width, height)
+        offset += pixels
+        tables['rgb'] = np.frombuffer(
+            data, dtype=np.uint8, count=pixels * 3, offset=offset,
+        ).reshape(width, height, 3)
+        return tables
+
+    def store(self, key, width, height, tables):
+        makedirs(self.path, exist_ok=True)
+        filename = self._filename(key)
+        fd, tmp_filename = mkstemp(dir=self.path, prefix=key, suffix=MAP_CACHE_TMP_SUFFIX)
+        try:
+            with fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(HEADER_MAGIC, MAP_CACHE_VERSION, width, height).ljust(
+                    HEADER_SIZE, b"\0",
+                ))
+                for field in COORDINATE_FIELDS:
+                    f.write(np.ascontiguousarray(tables[field], dtype="<f4").tobytes())
+                f.write(np.ascontiguousarray(tables['land'], dtype=np.uint8).tobytes())
+                f.write(np.ascontiguousarray(tables['colors'], dtype=np.uint8).tobytes())
+                f.write(np.ascontiguousarray(tables['rgb'], dtype=np.uint8).tobytes())
+            replace(tmp_filename, filename)
+        except BaseException:
+            remove(tmp_filename)
+            raise
+        self.evict(keep=filename)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits
+        into max_bytes again. Also cleans up build locks that no
+        process holds for entries that no longer exist, as well as
+        temporary files left behind by crashed processes.
+        """
+        entries = []
+        locks = []
+        total_bytes = 0
+        for filename in listdir(self.path):
+            if filename.endswith(MAP_CACHE_LOCK_SUFFIX):
+                locks.append(filename[:-len(MAP_CACHE_LOCK_SUFFIX)])
+                continue
+            filename = join(self.path, filename)
+            try:
+                file_stat = stat(filename)
+            except OSError:
+                continue
+            if filename.endswith(MAP_CACHE_SUFFIX):
+                entries.append((file_stat.st_mtime, file_stat.st_size, filename))
+                total_bytes += file_stat.st_size
+            elif (
+                filename.endswith(MAP_CACHE_TMP_SUFFIX) and
+                file_stat.st_mtime < time() - MAP_CACHE_STALE_SECONDS
+            ):
+                try:
+                    remove(filename)
+                except OSError:
+                    pass
+
+        existing = set()
+        for mtime, size, filename in sorted(entries):
+            if total_bytes <= self.max_bytes or filename == keep:
+                existing.add(filename)
+                continue
+            try:
+                remove(filename)
+            except OSError:
+                existing.add(filename)
+                continue
+            total_bytes -= size
+
+        for key in locks:
+            if self._filename(key) in existing:
+                continue
+            build_lock = BuildLock(join(self.path, key + MAP_CACHE_LOCK_SUFFIX))
+            try:
+                if build_lock.acquire(blocking=False):
+                    # at worst, a process that opened the lock file
+                    # before we removed it will build the entry again
+                    remove(build_lock.filename)
+            except OSError:
+                pass
+            finally:
+                build_lock.release()
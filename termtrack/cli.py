@@ -1,14 +1,18 @@
 import argparse
 import curses
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+from os import cpu_count
 from queue import Empty
 from threading import Thread
+from time import perf_counter
 
 from requests import get
 
 from . import VERSION_STRING
-from .body import BODY_MAP
+from .body import BODY_MAP, MAP_WORKERS_DEFAULT_MAX, MapBuilder
+from .cache import MapCache
 from .draw import (
     draw_apsides,
     draw_coverage,
@@ -21,13 +25,20 @@ from .draw import (
     draw_orbits,
     draw_planets,
     draw_satellite,
+    NIGHT_CACHE_MAX_BYTES,
+    NightShading,
+    ShadingCache,
+    sun_cell,
 )
-from .layer import Layer, pixel_from_layers
-from .satellite import ALIASES, EarthSatellite
-from .utils.curses import graceful_ctrlc, input_thread_body, setup
+from .layer import ArrayLayer, Compositor, Layer, LayerWorkers
+from .planets import latlon_for_planet
+from .satellite import ALIASES, EarthSatellite, read_tle_file
+from .utils.curses import FrameWriter, graceful_ctrlc, input_thread_body, setup
 from .utils.curses import (
     INPUT_CYCLE_ORBITS,
     INPUT_EXIT,
+    INPUT_LAYER_READY,
+    INPUT_MAP_READY,
     INPUT_TIME_MINUS_LONG,
     INPUT_TIME_MINUS_SHORT,
     INPUT_TIME_PAUSE,
@@ -47,36 +58,127 @@ from .utils.curses import (
 from .utils.text import format_seconds
 
 
-def check_for_resize(stdscr, body):
-    start = datetime.now()
-    height, width = stdscr.getmaxyx()
+def check_for_resize(stdscr, body, map_builder, curses_lock):
+    with curses_lock:
+        height, width = stdscr.getmaxyx()
 
     if body.height != height or body.width != width:
-        body = body.__class__(width, height)
-        progress_str = "0.0"
-        start = datetime.now()
-        for progress in body.prepare_map():
-            if progress_str != "{:.2f}".format(progress):
-                progress_str = "{:.2f}".format(progress)
-                elapsed_time = datetime.now() - start
-                eta = (elapsed_time / max(progress, 0.01)) * (100 - progress)
-                stdscr.erase()
-                stdscr.insstr(0, 0, "Rendering map (ETA {}, {}%)...".format(
-                    format_seconds(eta.total_seconds()),
-                    progress_str,
-                ))
-                stdscr.refresh()
-        return body, True
+        # keep showing a scaled version of what we have while the
+        # actual map is prepared in the background
+        map_builder.request(body.__class__, width, height)
+        if hasattr(body, "land"):
+            return body.preview(width, height, source=body), True
+        else:
+            return body.preview(width, height), True
+
+    finished_body = map_builder.poll()
+    if (
+        finished_body is not None and
+        finished_body.width == body.width and
+        finished_body.height == body.height
+    ):
+        return finished_body, True
     else:
         return body, False
 
 
-def redraw(stdscr, body, layers):
-    stdscr.erase()
-    for x in range(body.width):
-        for y in range(body.height):
-            char, color = pixel_from_layers(x, y, layers)
-            stdscr.insstr(y, x, char, curses.color_pair(color))
+def get_observer(me, observer):
+    """
+    Returns latitude and longitude of the observer given with -O or
+    found via IP-geolocation, or (None, None).
+    """
+    if observer is not None:
+        obs_latlon = observer.split()
+        return float(obs_latlon[0]), float(obs_latlon[1])
+    if me:
+        location_data = get("http://ip-api.com/json").json()
+        return location_data['lat'], location_data['lon']
+    return None, None
+
+
+def parse_size(size):
+    width, height = size.lower().split("x")
+    width, height = int(width), int(height)
+    if width < 2 or height < 2:
+        raise ValueError(size)
+    return width, height
+
+
+def warm_cache_entry(body_name, width, height):
+    start = perf_counter()
+    body = BODY_MAP[body_name](width, height)
+    for progress in body.prepare_map():
+        pass
+    return perf_counter() - start
+
+
+def warm_cache(sizes, body_names, workers):
+    """
+    Prepares maps for all combinations of the given sizes and bodies,
+    skipping those that are already cached.
+    """
+    map_cache = MapCache()
+    entries = []
+    for body_name in body_names:
+        body_class = BODY_MAP[body_name]
+        for width, height in sizes:
+            label = "{} {}x{}".format(body_class.NAME, width, height)
+            if map_cache.load(
+                "{}_{}x{}".format(body_class.NAME, width, height),
+                width,
+                height,
+            ) is not None:
+                print("{}: already cached".format(label))
+            else:
+                entries.append((label, body_name, width, height))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(warm_cache_entry, body_name, width, height): label
+            for label, body_name, width, height in entries
+        }
+        for future in as_completed(futures):
+            print("{}: prepared in {:.2f}s".format(futures[future], future.result()))
+
+
+def print_passes(satellites, observer_latitude, observer_longitude, days):
+    """
+    Prints a table of all passes of the given satellites over the
+    observer during the next days, ordered by time of AOS.
+    """
+    start = datetime.now(timezone.utc)
+    end = start + timedelta(days=days)
+    passes = []
+    for satellite in satellites:
+        for aos, tca, max_elevation, los in satellite.passes(
+            start,
+            end,
+            observer_latitude,
+            observer_longitude,
+        ):
+            passes.append((aos, satellite.name, tca, max_elevation, los))
+    passes.sort()
+
+    name_width = max([len("Satellite")] + [len(satellite.name) for satellite in satellites])
+    time_format = "%Y-%m-%d %H:%M:%S"
+    print("{:<{}}  {:<19}  {:<19}  {:>6}  {:<19}  {}".format(
+        "Satellite", name_width, "AOS (UTC)", "TCA (UTC)", "Max El", "LOS (UTC)", "Duration",
+    ))
+    for aos, name, tca, max_elevation, los in passes:
+        print("{:<{}}  {}  {}  {:>5.1f}°  {}  {}".format(
+            name,
+            name_width,
+            aos.strftime(time_format),
+            tca.strftime(time_format),
+            max_elevation,
+            los.strftime(time_format),
+            format_seconds((los - aos).total_seconds()),
+        ))
+
+
+def redraw(frame_writer, body, compositor):
+    chars, colors = compositor.compose(body.width, body.height)
+    frame_writer.write(chars, colors)
 
 
 @graceful_ctrlc
@@ -90,8 +192,10 @@ def render(
         fps=1,
         grid=False,
         info=False,
+        map_workers=1,
         me=False,
         night=False,
+        night_cache_mb=NIGHT_CACHE_MAX_BYTES // (1024 * 1024),
         observer=None,
         orbit_ascdesc=False,
         orbit_res="/70",
@@ -108,6 +212,11 @@ def render(
         target=input_thread_body,
     )
     input_thread.start()
+    map_builder = MapBuilder(
+        on_ready=lambda: input_queue.put(INPUT_MAP_READY),
+        workers=map_workers,
+    )
+    layer_workers = LayerWorkers(on_ready=lambda: input_queue.put(INPUT_LAYER_READY))
     try:
         body = BODY_MAP[body.lower()](1, 1)
         if body.NAME != "Earth":
@@ -116,19 +225,12 @@ def render(
             me = False
             satellite = None
 
-        observer_latitude = None
-        observer_longitude = None
-        if me and observer is None:
-            location_data = get("http://ip-api.com/json").json()
-            observer_latitude = location_data['lat']
-            observer_longitude = location_data['lon']
-        if observer is not None:
-            obs_latlon = observer.split()
-            observer_latitude = float(obs_latlon[0])
-            observer_longitude = float(obs_latlon[1])
+        observer_latitude, observer_longitude = get_observer(me, observer)
 
         time_offset = timedelta(0)
         time = datetime.now(timezone.utc) + time_offset
+        sun_position = None
+        sun_time = None
         force_redraw = False
 
         if paused is True:
@@ -145,24 +247,44 @@ def render(
                 observer_longitude=observer_longitude,
                 tle_file=tle,
             )
+        satellite_time = time
 
-        apsides_layer = Layer(draw_apsides, update_timeout=8)
+        apsides_layer = Layer(
+            draw_apsides,
+            inputs=("body", "satellite", "time"),
+            time_quantum=8,
+        )
         apsides_layer.hidden = not apsides
-        coverage_layer = Layer(draw_coverage, update_timeout=10)
+        coverage_layer = ArrayLayer(
+            draw_coverage,
+            inputs=("body", "satellite", "time"),
+            time_quantum=10,
+            workers=layer_workers,
+        )
         coverage_layer.hidden = not coverage
-        crosshair_layer = Layer(draw_crosshair)
+        crosshair_layer = Layer(draw_crosshair, inputs=("body", "satellite", "time"))
         crosshair_layer.hidden = not crosshair
-        footprint_layer = Layer(draw_footprint)
+        footprint_layer = Layer(draw_footprint, inputs=("body", "satellite", "time"))
         footprint_layer.hidden = not footprint
-        grid_layer = Layer(draw_grid, update_timeout=None)
+        grid_layer = Layer(draw_grid, inputs=("body",))
         grid_layer.hidden = not grid
-        info_layer = Layer(draw_info)
+        info_layer = Layer(draw_info, inputs=("body", "observer", "satellite", "time"))
         info_layer.hidden = not info
-        map_layer = Layer(draw_map, update_timeout=None)
-        observer_layer = Layer(draw_location, update_timeout=None)
-        orbit_layer = Layer(draw_orbits)
-        planet_layer = Layer(draw_planets)
-        satellite_layer = Layer(draw_satellite)
+        map_layer = ArrayLayer(draw_map, inputs=("body", "night", "sun", "topo"))
+        night_shading = NightShading(cache=ShadingCache(night_cache_mb * 1024 * 1024))
+        observer_layer = Layer(draw_location, inputs=("body", "observer"))
+        orbit_layer = Layer(
+            draw_orbits,
+            inputs=("body", "orbits", "satellite", "time"),
+            time_quantum=5,
+            workers=layer_workers,
+        )
+        planet_layer = Layer(
+            draw_planets,
+            inputs=("body", "planets", "time"),
+            time_quantum=60,
+        )
+        satellite_layer = Layer(draw_satellite, inputs=("body", "satellite", "time"))
         satellite_layer.hidden = satellite_obj is None
 
         layers = [
@@ -178,40 +300,68 @@ def render(
             crosshair_layer,
             grid_layer,
         ]
+        frame_writer = FrameWriter(stdscr)
+        compositor = Compositor(
+            layers,
+            static_layers=(map_layer, grid_layer, observer_layer, crosshair_layer),
+        )
 
         while True:
-            with curses_lock:
-                body, did_resize = check_for_resize(stdscr, body)
+            body, did_resize = check_for_resize(stdscr, body, map_builder, curses_lock)
             if did_resize:
-                for layer in layers:
-                    layer.last_updated = None
+                force_redraw = True
 
             draw_start = datetime.now()
             if not paused:
                 time = datetime.now(timezone.utc) + time_offset
-            if force_redraw:
-                for layer in layers:
-                    layer.last_updated = None
+            if night:
+                # the sun moves by less than a cell per minute
+                sun_minute = time.replace(second=0, microsecond=0)
+                if sun_minute != sun_time:
+                    sun_time = sun_minute
+                    sun_position = latlon_for_planet('sun', sun_time)
+            inputs = {
+                'body': body,
+                'night': night,
+                'observer': (observer_latitude, observer_longitude),
+                'orbits': (orbits, orbit_ascdesc, orbit_res),
+                'planets': planets,
+                'satellite': None if satellite_obj is None else satellite_obj.epoch,
+                'sun': sun_cell(body, *sun_position) if night else None,
+                'time': time,
+                'topo': topo,
+            }
             if not paused or force_redraw:
-                grid_layer.update(body)
+                grid_layer.update(inputs, body)
                 info_layer.update(
+                    inputs,
                     body,
                     time,
                     observer_latitude=observer_latitude,
                     observer_longitude=observer_longitude,
                     satellite=satellite_obj,
                 )
-                map_layer.update(body, time, night=night, topo=topo)
-                observer_layer.update(body, observer_latitude, observer_longitude)
-                planet_layer.update(body, time, planets)
+                map_layer.update(
+                    inputs,
+                    body,
+                    time,
+                    night=night,
+                    topo=topo,
+                    shading=night_shading,
+                )
+                observer_layer.update(inputs, body, observer_latitude, observer_longitude)
+                planet_layer.update(inputs, body, time, planets)
 
                 if satellite_obj is not None:
-                    satellite_obj.compute(time)
-                    apsides_layer.update(body, satellite_obj)
-                    coverage_layer.update(body, satellite_obj, time)
-                    crosshair_layer.update(body, satellite_obj)
-                    footprint_layer.update(body, satellite_obj)
+                    if time != satellite_time:
+                        satellite_obj.compute(time)
+                        satellite_time = time
+                    apsides_layer.update(inputs, body, satellite_obj)
+                    coverage_layer.update(inputs, body, satellite_obj, time)
+                    crosshair_layer.update(inputs, body, satellite_obj)
+                    footprint_layer.update(inputs, body, satellite_obj)
                     orbit_layer.update(
+                        inputs,
                         body,
                         satellite_obj,
                         time,
@@ -219,10 +369,12 @@ def render(
                         orbit_ascdesc=orbit_ascdesc,
                         orbit_resolution=orbit_res,
                     )
-                    satellite_layer.update(body, satellite_obj)
+                    satellite_layer.update(inputs, body, satellite_obj)
 
+                # swap in layers finished in the background
+                layer_workers.poll()
                 with curses_lock:
-                    redraw(stdscr, body, layers)
+                    redraw(frame_writer, body, compositor)
 
             draw_time = (datetime.now() - draw_start).total_seconds()
 
@@ -274,7 +426,6 @@ def render(
                     paused = time = datetime.now(timezone.utc)
             elif input_action == INPUT_TOGGLE_COVERAGE:
                 coverage_layer.hidden = not coverage_layer.hidden
-                coverage_layer.last_updated = None
             elif input_action == INPUT_TOGGLE_CROSSHAIR:
                 crosshair_layer.hidden = not crosshair_layer.hidden
             elif input_action == INPUT_TOGGLE_FOOTPRINT:
@@ -285,22 +436,16 @@ def render(
                 info_layer.hidden = not info_layer.hidden
             elif input_action == INPUT_TOGGLE_NIGHT:
                 night = not night
-                map_layer.last_updated = None
-                if night:
-                    map_layer.update_timeout = timedelta(seconds=60)
-                else:
-                    map_layer.update_timeout = None
             elif input_action == INPUT_TOGGLE_ORBIT_APSIDES:
                 apsides_layer.hidden = not apsides_layer.hidden
-                apsides_layer.last_updated = None
             elif input_action == INPUT_TOGGLE_ORBIT_ASCDESC:
                 orbit_ascdesc = not orbit_ascdesc
-                orbit_layer.last_updated = None
             elif input_action == INPUT_TOGGLE_TOPO:
                 topo = not topo
-                map_layer.last_updated = None
     finally:
         quit_event.set()
+        layer_workers.shutdown()
+        map_builder.stop()
         input_thread.join()
 
 
@@ -362,7 +507,8 @@ def main():
         '-b', '--body',
         default='earth',
         metavar='BODY',
-        help="which celestial body to draw: Earth, Moon or Mars (default: Earth)",
+        help="which celestial body to draw: Earth, Moon or Mars (default: Earth); "
+             "with --warm-cache, this can be a comma-separated list",
     )
     parser.add_argument(
         '-c', '--coverage',
@@ -391,6 +537,14 @@ def main():
         action='store_true',
         help="show info panels",
     )
+    parser.add_argument(
+        '--map-workers',
+        type=int,
+        default=min(cpu_count() or 1, MAP_WORKERS_DEFAULT_MAX),
+        metavar='N',
+        help="number of processes used to prepare maps for large terminals "
+             "(default: number of CPUs, at most {})".format(MAP_WORKERS_DEFAULT_MAX),
+    )
     parser.add_argument(
         '-m', '--me',
         action='store_true',
@@ -401,6 +555,14 @@ def main():
         action='store_true',
         help="shade night side",
     )
+    parser.add_argument(
+        '--night-cache-mb',
+        type=int,
+        default=NIGHT_CACHE_MAX_BYTES // (1024 * 1024),
+        metavar='N',
+        help="memory used to remember night-shaded maps while moving "
+             "through time (default: %(default)s)",
+    )
     parser.add_argument(
         '-o', '--orbits',
         type=int,
@@ -419,6 +581,15 @@ def main():
         metavar="'LAT LON'",
         help="space-separated latitude and longitude of an observer; overrides IP-geolocation",
     )
+    parser.add_argument(
+        '--passes',
+        type=float,
+        default=None,
+        metavar='DAYS',
+        help="print all passes over the observer during the next DAYS days "
+             "and exit; SATELLITE can be a comma-separated list and all "
+             "satellites in --tle are included",
+    )
     parser.add_argument(
         '-p', '--paused',
         action='store_true',
@@ -450,6 +621,13 @@ def main():
         help="read TLE data from FILE instead of downloading it "
              "(SATELLITE will have no effect and can be omitted)",
     )
+    parser.add_argument(
+        '--warm-cache',
+        default=None,
+        metavar='SIZES',
+        help="prepare maps for a comma-separated list of terminal sizes "
+             "(e.g. '200x60,400x120') and exit",
+    )
     parser.add_argument(
         '-x', '--crosshair',
         action='store_true',
@@ -468,6 +646,48 @@ def main():
             print("{}: {}".format(alias, ALIASES[alias]))
         sys.exit(0)
 
+    if args.passes is not None:
+        observer_latitude, observer_longitude = get_observer(args.me, args.observer)
+        if observer_latitude is None:
+            parser.error("--passes requires an observer (-O or --me)")
+        now = datetime.now(timezone.utc)
+        satellites = []
+        if args.satellite is not None:
+            for satellite in args.satellite.split(","):
+                satellites.append(EarthSatellite(
+                    satellite.strip(),
+                    now,
+                    observer_latitude=None,
+                    observer_longitude=None,
+                ))
+        if args.tle is not None:
+            for tle in read_tle_file(args.tle):
+                satellites.append(EarthSatellite(
+                    None,
+                    now,
+                    observer_latitude=None,
+                    observer_longitude=None,
+                    tle=tle,
+                ))
+        if not satellites:
+            parser.error("--passes requires SATELLITE or --tle")
+        print_passes(satellites, observer_latitude, observer_longitude, args.passes)
+        sys.exit(0)
+
+    if args.warm_cache is not None:
+        try:
+            sizes = [parse_size(size) for size in args.warm_cache.split(",")]
+        except ValueError:
+            parser.error("invalid size in --warm-cache: {}".format(args.warm_cache))
+        body_names = [name.strip().lower() for name in args.body.split(",")]
+        for body_name in body_names:
+            if body_name not in BODY_MAP:
+                parser.error("unknown body: {}".format(body_name))
+        # aliases such as 'luna' would otherwise prepare the same maps twice
+        body_names = list({BODY_MAP[name]: name for name in body_names}.values())
+        warm_cache(sizes, body_names, args.map_workers)
+        sys.exit(0)
+
     curses.wrapper(
         render,
         apsides=args.apsides,
@@ -478,8 +698,10 @@ def main():
         fps=args.fps,
         grid=args.grid,
         info=args.info,
+        map_workers=args.map_workers,
         me=args.me,
         night=args.night,
+        night_cache_mb=args.night_cache_mb,
         observer=args.observer,
         orbit_ascdesc=args.orbit_ascdesc,
         orbit_res=args.orbit_res,
@@ -1,9 +1,12 @@
+from collections import OrderedDict
 from datetime import timedelta
 from math import acos, cos, degrees, pi, radians, sin
 
+import numpy as np
+
 from .planets import PLANET_SYMBOLS, latlon_for_planet
 from .satellite import earth_radius_at_latitude
-from .utils.curses import bresenham, closest_color, fill_outline
+from .utils.curses import bresenham, closest_colors, fill_outline
 from .utils.geometry import (
     cartesian_to_latlon,
     latlon_to_cartesian,
@@ -18,26 +21,179 @@ GRID_LONGITUDES = (150, 120, 90, 60, 30, 0, -30, -60, -90, -120, -150)
 
 HALF_PI = pi / 2
 ASTRO_TWILIGHT = radians(-18)
+NIGHT_CACHE_MAX_BYTES = 16 * 1024 * 1024
 
 
 class InfoPanel(list):
     pass
 
 
+class NightShading:
+    """
+    Computes the colors of all land cells for draw_map() with night
+    shading enabled.
+
+    Cells are kept sorted by their sun altitude at a reference sub-solar
+    point. Once the sun has moved by some angle from there, no cell's
+    sun altitude can have changed by more than that angle, so only
+    cells that were within that angle of the twilight band need to be
+    recomputed. All others are still fully lit or fully dark and use
+    colors computed once per body and topo setting. When the sun has
+    drifted further than max_drift, a new reference is computed for all
+    cells to keep the band narrow.
+
+    If a ShadingCache is given, the sub-solar point is rounded to the
+    nearest map cell and shaded maps are looked up in the cache first.
+    """
+    def __init__(self, cache=None, max_drift=radians(5)):
+        self.cache = cache
+        self.max_drift = max_drift
+        self._body = None
+        self._reference_sun = None
+        self._topo = None
+
+    def _reset(self, body, topo):
+        land = body.land
+        if topo is True:
+            rgb = body.rgb[land].astype(np.float64)
+            day_colors = body.colors[land]
+        else:
+            rgb = np.tile(np.array([0.0, 249.0, 114.0]), (np.count_nonzero(land), 1))
+            day_colors = np.full(len(rgb), 48, dtype=np.uint8)
+        night_rgb = np.empty_like(rgb)
+        night_rgb[:, 0] = 0
+        night_rgb[:, 1] = rgb[:, 1] * 0.2
+        night_rgb[:, 2] = np.minimum(rgb[:, 2] + 40, 255)
+
+        self._cells = {
+            # same colors as without night shading
+            'day_colors': day_colors,
+            'index': np.arange(len(rgb)),
+            'night_colors': closest_colors(night_rgb, exact=True),
+            'night_rgb': night_rgb,
+            'rgb': rgb,
+            'trig': np.stack([values[land] for values in body.latlon_trig]),
+        }
+        self._xs, self._ys = land.nonzero()
+        self._body = body
+        self._reference_sun = None
+        self._topo = topo
+
+    def _set_reference(self, sun_lat, sun_lon):
+        altitudes = sun_altitudes(*self._cells['trig'], sun_lat, sun_lon)
+        order = np.argsort(altitudes, kind='stable')
+        for key, values in self._cells.items():
+            self._cells[key] = values[..., order] if key == 'trig' else values[order]
+        self._altitudes = altitudes[order]
+        self._reference_sun = latlon_to_cartesian(sun_lat, sun_lon)
+
+    def _shade(self, sun_lat, sun_lon):
+        if self._reference_sun is None:
+            drift = None
+        else:
+            sun = latlon_to_cartesian(sun_lat, sun_lon)
+            drift = acos(max(-1.0, min(1.0, sum(
+                a * b for a, b in zip(sun, self._reference_sun)
+            ))))
+        if drift is None or drift > self.max_drift:
+            self._set_reference(sun_lat, sun_lon)
+            drift = 0.0
+
+        # cells that were darker than this are still fully dark,
+        # cells that were brighter than this are still fully lit
+        band_start = np.searchsorted(self._altitudes, ASTRO_TWILIGHT - drift, side='left')
+        band_end = np.searchsorted(self._altitudes, drift, side='right')
+
+        cells = self._cells
+        band = slice(band_start, band_end)
+        night_factor = night_factors(
+            sun_altitudes(*cells['trig'][:, band], sun_lat, sun_lon),
+        )[:, None]
+        band_colors = closest_colors(
+            (1 - night_factor) * cells['rgb'][band] +
+            night_factor * cells['night_rgb'][band],
+            exact=True,
+        )
+        colors = np.empty_like(cells['day_colors'])
+        colors[cells['index'][:band_start]] = cells['night_colors'][:band_start]
+        colors[cells['index'][band]] = band_colors
+        colors[cells['index'][band_end:]] = cells['day_colors'][band_end:]
+        return colors
+
+    def update(self, body, sun_lat, sun_lon, topo=True):
+        """
+        Returns x coordinates, y coordinates and colors of all land
+        cells as arrays.
+        """
+        if body is not self._body or topo != self._topo:
+            self._reset(body, topo)
+
+        # previews may be derived from a different size each time, so
+        # their shading can't be reused
+        if self.cache is None or body.is_preview:
+            return self._xs, self._ys, self._shade(sun_lat, sun_lon)
+
+        cell = sun_cell(body, sun_lat, sun_lon)
+        key = (body.NAME, body.width, body.height, topo, cell)
+        colors = self.cache.get(key)
+        if colors is None:
+            colors = self._shade(cell[0] * 180 / body.height, cell[1] * 360 / body.width)
+            self.cache.put(key, colors)
+        return self._xs, self._ys, colors
+
+
+class ShadingCache:
+    """
+    Remembers the land colors computed by NightShading, so going back
+    and forth in time doesn't require shading the same map twice. Once
+    the stored colors take up more than max_bytes, the least recently
+    used entries are dropped.
+    """
+    def __init__(self, max_bytes=NIGHT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        try:
+            colors = self._entries[key]
+        except KeyError:
+            return None
+        self._entries.move_to_end(key)
+        return colors
+
+    def put(self, key, colors):
+        if colors.nbytes > self.max_bytes:
+            return
+        colors.flags.writeable = False
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.nbytes
+        self._entries[key] = colors
+        self.size += colors.nbytes
+        while self.size > self.max_bytes:
+            key, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+
 def draw_coverage(layer, body, satellite, time, steps=100):
     interval = satellite.orbital_period.total_seconds() / steps
     footprints = set([])
 
-    for i in range(steps):
-        satellite.compute(time, plus_seconds=interval * i)
-        earth_radius = earth_radius_at_latitude(satellite.latitude)
-        horizon_radius = acos(earth_radius / (earth_radius + satellite.altitude))
-        sat_xy = body.from_latlon(satellite.latitude, satellite.longitude)
+    latitudes, longitudes, altitudes = satellite.track(time, interval, steps)[:3]
+    for latitude, longitude, altitude in zip(
+        latitudes.tolist(),
+        longitudes.tolist(),
+        altitudes.tolist(),
+    ):
+        earth_radius = earth_radius_at_latitude(latitude)
+        horizon_radius = acos(earth_radius / (earth_radius + altitude))
+        sat_xy = body.from_latlon(latitude, longitude)
         sat_footprints = []
 
         for hx, hy, hz in cartesian_rotation(
-            satellite.latitude,
-            satellite.longitude,
+            latitude,
+            longitude,
             horizon_radius,
             steps=int(body.width / 4),  # somewhat arbitrary
         ):
@@ -49,17 +205,11 @@ def draw_coverage(layer, body, satellite, time, steps=100):
 
     # now we have gathered the swept area, but we want to hide areas
     # *not* covered during the orbit
-    inverted_footprints = []
-    for x in range(body.width):
-        for y in range(body.height):
-            if (x, y) not in footprints:
-                inverted_footprints.append((x, y))
-
-    for x, y in inverted_footprints:
-        layer.draw(x, y, "•", 94)
-
-    # reset satellite to current position
-    satellite.compute(time)
+    covered = np.zeros((body.width, body.height), dtype=bool)
+    for x, y in footprints:
+        if 0 <= x < body.width and 0 <= y < body.height:
+            covered[x, y] = True
+    layer.draw_many(*np.nonzero(~covered), "•", 94)
 
 
 def draw_grid(layer, body):
@@ -73,8 +223,9 @@ def draw_grid(layer, body):
         longitudes.append(x)
 
     for x in range(body.width-1):
+        land = body.column("land", x).tolist()
         for y in range(body.height):
-            if body.map[x][y][3] is None:
+            if not land[y]:
                 if x in longitudes and y in latitudes:
                     layer.draw(x, y, "┼", 234)
                 elif x in longitudes:
@@ -235,47 +386,52 @@ def draw_info(
                 layer.draw(text.x + x, text.y + y, char, 0)
 
 
-def draw_map(layer, body, time, night=True, topo=True):
+def draw_map(layer, body, time, night=True, topo=True, shading=None):
     if night:
+        if shading is None:
+            shading = NightShading()
         sun_lat, sun_lon = latlon_for_planet('sun', time)
-        sun_lat_rad = radians(sun_lat)
-        sun_lon_rad = radians(sun_lon)
-        cos_sun_lat = cos(sun_lat_rad)
-        sin_sun_lat = sin(sun_lat_rad)
+        xs, ys, colors = shading.update(body, sun_lat, sun_lon, topo=topo)
+    else:
+        xs, ys = body.land.nonzero()
+        if topo is True:
+            colors = body.colors[body.land]
+        else:
+            colors = np.full(len(xs), 48, dtype=np.uint8)
 
-    for x in range(body.width):
-        for y in range(body.height):
-            if night:
-                lat, lon = body.to_latlon(x, y)
-                lat_rad = radians(lat)
-                lon_rad = radians(lon)
-
-                # calculate angular distance from sub-solar point using spherical law of cosines
-                cos_angular_dist = (
-                    sin(lat_rad) * sin_sun_lat +
-                    cos(lat_rad) * cos_sun_lat * cos(lon_rad - sun_lon_rad)
-                )
-                cos_angular_dist = max(-1.0, min(1.0, cos_angular_dist))
-                angular_dist = acos(cos_angular_dist)
-                sun_alt = HALF_PI - angular_dist
-                night_factor = max(min(sun_alt, 0), ASTRO_TWILIGHT) / ASTRO_TWILIGHT
-            else:
-                night_factor = -1
-
-            if body.map[x][y][3] is not None:
-                if topo is True:
-                    r, g, b, color = body.map[x][y][:4]
-                else:
-                    r, g, b, color = 0, 249, 114, 48
-                if night_factor > -0.001:
-                    night_r = 0
-                    night_g = g * 0.2
-                    night_b = min(b + 40, 255)
-                    effective_r = ((1 - night_factor) * r) + (night_factor * night_r)
-                    effective_g = ((1 - night_factor) * g) + (night_factor * night_g)
-                    effective_b = ((1 - night_factor) * b) + (night_factor * night_b)
-                    color = closest_color(effective_r, effective_g, effective_b)
-                layer.draw(x, y, "•", color)
+    layer.draw_many(xs, ys, "•", colors)
+
+
+def night_factors(sun_altitudes):
+    """
+    Maps sun altitudes to values ranging from 0 (daylight) to 1 (night)
+    with astronomical twilight in between.
+    """
+    return np.clip(sun_altitudes, ASTRO_TWILIGHT, 0) / ASTRO_TWILIGHT
+
+
+def sun_cell(body, sun_lat, sun_lon):
+    """
+    Returns the sub-solar point rounded to the size of one map cell,
+    in multiples of that size.
+    """
+    return round(sun_lat * body.height / 180), round(sun_lon * body.width / 360)
+
+
+def sun_altitudes(sin_lat, cos_lat, sin_lon, cos_lon, sun_lat, sun_lon):
+    """
+    Returns the sun altitude in radians for points given by the sines
+    and cosines of their latitudes and longitudes.
+    """
+    sun_lat_rad = radians(sun_lat)
+    sun_lon_rad = radians(sun_lon)
+
+    # calculate angular distance from sub-solar point using spherical law of cosines
+    cos_angular_dist = (
+        sin_lat * sin(sun_lat_rad) +
+        cos_lat * cos(sun_lat_rad) * (cos_lon * cos(sun_lon_rad) + sin_lon * sin(sun_lon_rad))
+    )
+    return HALF_PI - np.arccos(np.clip(cos_angular_dist, -1.0, 1.0))
 
 
 def draw_orbits(
@@ -289,7 +445,6 @@ def draw_orbits(
 ):
     if orbits == 0:
         return
-    orbit_offset = timedelta()
     continuous = False
     if orbit_resolution.endswith("+"):
         continuous = True
@@ -299,25 +454,32 @@ def draw_orbits(
     else:
         orbit_increment = timedelta(minutes=float(orbit_resolution))
 
-    satellite.compute(time)
-    previous_altitude = satellite.altitude
+    # number of markers with an offset below the end of the last orbit
+    markers = -(-(satellite.orbital_period * orbits + orbit_increment) // orbit_increment)
+    latitudes, longitudes, altitudes = satellite.track(
+        time,
+        orbit_increment.total_seconds(),
+        markers,
+    )[:3]
+    previous_altitude = altitudes[0]
 
     orbit_markers = []
 
-    while orbit_offset < satellite.orbital_period * orbits + orbit_increment:
-        satellite.compute(time, plus_seconds=orbit_offset.total_seconds())
-
+    for latitude, longitude, altitude in zip(
+        latitudes.tolist(),
+        longitudes.tolist(),
+        altitudes.tolist(),
+    ):
         if orbit_ascdesc:
-            if satellite.altitude - previous_altitude >= 0:
+            if altitude - previous_altitude >= 0:
                 char = "+"
             else:
                 char = "-"
-            previous_altitude = satellite.altitude
+            previous_altitude = altitude
         else:
             char = "•"
 
-        orbit_markers.append((body.from_latlon(satellite.latitude, satellite.longitude), char))
-        orbit_offset += orbit_increment
+        orbit_markers.append((body.from_latlon(latitude, longitude), char))
 
     if continuous:
         orbit_marker_dict = dict(orbit_markers)
@@ -339,9 +501,6 @@ def draw_orbits(
         for point, char in orbit_markers:
             layer.draw(point[0], point[1], char, 209)
 
-    # reset values to current
-    satellite.compute(time)
-
 
 def draw_planets(layer, body, time, planets):
     for planet in planets.split(","):
@@ -459,11 +618,13 @@ def draw_crosshair(layer, body, satellite):
         x, y = body.from_latlon(satellite.latitude, satellite.longitude)
     except ValueError:
         return
+    land = body.row("land", y).tolist()
     for i in range(body.width-1):
-        if body.map[i][y][3] is None:
+        if not land[i]:
             layer.draw(i, y, "─", 235)
+    land = body.column("land", x).tolist()
     for i in range(body.height):
-        if body.map[x][i][3] is None:
+        if not land[i]:
             layer.draw(x, i, "│", 235)
 
 
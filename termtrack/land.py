@@ -0,0 +1,90 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+import shapefile
+
+
+class LandPolygons:
+    """
+    All polygons from a shapefile, decoded once into flat coordinate
+    arrays with precomputed bounding boxes.
+    """
+    def __init__(self, path):
+        self.bboxes = []
+        self.offsets = array('L', [0])
+        self.xs = array('d')
+        self.ys = array('d')
+
+        reader = shapefile.Reader(path)
+        try:
+            for shape in reader.iterShapes():
+                for x, y in shape.points:
+                    self.xs.append(x)
+                    self.ys.append(y)
+                self.offsets.append(len(self.xs))
+                self.bboxes.append(tuple(shape.bbox))
+        finally:
+            reader.close()
+
+    def rasterize(self, latitudes, longitudes):
+        """
+        Returns a land mask as a list of bytearrays, one for each entry
+        in latitudes, holding a 1 for each of the given (ascending)
+        longitudes that lies within a polygon.
+
+        Instead of testing each pixel on its own, this collects the
+        edge crossings of every row and fills the spans between them
+        according to the even-odd rule, yielding the same result as
+        testing each pixel with point_in_poly() at a fraction of the
+        cost.
+        """
+        mask = [bytearray(len(longitudes)) for lat in latitudes]
+        rows = sorted(range(len(latitudes)), key=lambda row: latitudes[row])
+        sorted_latitudes = [latitudes[row] for row in rows]
+        xs = self.xs
+        ys = self.ys
+
+        for polygon, bbox in enumerate(self.bboxes):
+            start = self.offsets[polygon]
+            end = self.offsets[polygon + 1]
+            crossings = {}
+
+            p1x, p1y = xs[end - 1], ys[end - 1]
+            for i in range(start, end):
+                p2x, p2y = xs[i], ys[i]
+                if p1y != p2y:
+                    max_x = max(p1x, p2x)
+                    # rows with min(p1y, p2y) < lat <= max(p1y, p2y)
+                    for k in range(
+                        bisect_right(sorted_latitudes, min(p1y, p2y)),
+                        bisect_right(sorted_latitudes, max(p1y, p2y)),
+                    ):
+                        y = sorted_latitudes[k]
+                        xints = (y-p1y) * (p2x-p1x) / (p2y-p1y) + p1x
+                        crossings.setdefault(rows[k], []).append(min(xints, max_x))
+                p1x, p1y = p2x, p2y
+
+            for row, row_crossings in crossings.items():
+                if not bbox[1] < latitudes[row] < bbox[3]:
+                    continue
+                row_crossings.sort()
+                row_mask = mask[row]
+                # a longitude is inside if an odd number of crossings
+                # lie at or to the east of it
+                n = len(row_crossings)
+                for j in range(n - 1, -1, -2):
+                    west = row_crossings[j - 1] if j > 0 else bbox[0]
+                    first = bisect_right(longitudes, max(west, bbox[0]))
+                    last = min(
+                        bisect_right(longitudes, row_crossings[j]),
+                        bisect_left(longitudes, bbox[2]),
+                    )
+                    if last > first:
+                        row_mask[first:last] = b"\x01" * (last - first)
+        return mask
+
+
+@lru_cache(maxsize=None)
+def load_land_polygons(path):
+    return LandPolygons(path)
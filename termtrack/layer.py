@@ -1,4 +1,7 @@
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
 
 
 def pixel_from_layers(x, y, layers):
@@ -12,30 +15,412 @@ def pixel_from_layers(x, y, layers):
     return " ", 1
 
 
+def union_rect(rect1, rect2):
+    """
+    Returns the smallest (x_min, y_min, x_max, y_max) rectangle (with
+    exclusive upper bounds) containing both rectangles, either of which
+    may be None.
+    """
+    if rect1 is None:
+        return rect2
+    if rect2 is None:
+        return rect1
+    return (
+        min(rect1[0], rect2[0]),
+        min(rect1[1], rect2[1]),
+        max(rect1[2], rect2[2]),
+        max(rect1[3], rect2[3]),
+    )
+
+
 class Layer:
-    def __init__(self, update_callback, update_timeout=0):
+    """
+    A layer is only recomputed when one of its declared inputs has
+    changed since its last update. inputs is a sequence of names to
+    look up in the dict passed to update(). The special input "time"
+    is rounded down to multiples of time_quantum seconds (if given)
+    before being compared.
+
+    If workers (a LayerWorkers instance) is given, the layer is computed
+    in the background and keeps its previous content until the new
+    content is complete.
+    """
+    def __init__(self, update_callback, inputs=(), time_quantum=None, workers=None):
         self.content = {}
         self.hidden = False
-        self.last_updated = None
+        self.inputs = tuple(inputs)
+        self.time_quantum = time_quantum
         self.update_callback = update_callback
-        if update_timeout is None:
-            self.update_timeout = None
-        else:
-            self.update_timeout = timedelta(seconds=update_timeout)
+        self.version = 0
+        self.workers = workers
+        self._input_values = None
 
     def draw(self, x, y, char, color):
         self.content[(x, y)] = (char, color)
 
-    def update(self, *args, **kwargs):
-        if (
-            self.hidden or
-            (self.last_updated and (
-                self.update_timeout is None or
-                datetime.now(timezone.utc) - self.last_updated < self.update_timeout
-            ))
-        ):
+    def draw_many(self, xs, ys, char, colors):
+        """
+        Draws char at all given coordinates, with colors being either a
+        single color or one per coordinate.
+        """
+        xs = np.asarray(xs).tolist()
+        ys = np.asarray(ys).tolist()
+        for x, y, color in zip(xs, ys, np.broadcast_to(colors, len(xs)).tolist()):
+            self.draw(x, y, char, color)
+
+    def input_values(self, inputs):
+        values = []
+        for name in self.inputs:
+            value = inputs[name]
+            if name == "time" and self.time_quantum:
+                value = int(value.timestamp() // self.time_quantum)
+            values.append(value)
+        return tuple(values)
+
+    def needs_update(self, inputs):
+        """
+        Returns True and remembers the current input values if the layer
+        is visible and its inputs have changed.
+        """
+        if self.hidden:
+            return False
+        input_values = self.input_values(inputs)
+        if input_values == self._input_values:
+            return False
+        self._input_values = input_values
+        return True
+
+    def render(self, *args, **kwargs):
+        """
+        Returns a new layer of the same type holding the result of the
+        update callback, leaving this layer untouched.
+        """
+        scratch = Layer(self.update_callback)
+        self.update_callback(scratch, *args, **kwargs)
+        return scratch
+
+    def swap(self, scratch):
+        """
+        Replaces the content of this layer with that of a layer
+        returned by render().
+        """
+        if scratch.content != self.content:
+            self.content = scratch.content
+            self.version += 1
+
+    def update(self, inputs, *args, **kwargs):
+        if not self.needs_update(inputs):
+            return
+        if self.workers is not None:
+            self.workers.submit(self, args, kwargs)
             return
 
-        self.last_updated = datetime.now(timezone.utc)
+        previous_content = self.content
         self.content = {}
         self.update_callback(self, *args, **kwargs)
+        if self.content != previous_content:
+            self.version += 1
+
+
+class ArrayContent:
+    """
+    Read-only mapping from (x, y) to (char, color) on top of the arrays
+    of an ArrayLayer, so it can be used in place of Layer.content.
+    """
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __contains__(self, xy):
+        try:
+            self[xy]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, xy):
+        x, y = xy
+        layer = self.layer
+        if (
+            layer.mask is None or
+            not 0 <= x < layer.width or
+            not 0 <= y < layer.height or
+            not layer.mask[x, y]
+        ):
+            raise KeyError(xy)
+        return str(layer.chars[x, y]), int(layer.colors[x, y])
+
+
+class ArrayLayer(Layer):
+    """
+    A Layer that stores its content in dense arrays indexed by [x, y]
+    instead of a dict, which is cheaper for layers covering large parts
+    of the screen:
+
+        chars   the character drawn in each cell
+        colors  the color of each cell
+        mask    True for cells this layer has drawn on
+
+    Arrays are reused between updates. dirty holds the rectangle
+    (x_min, y_min, x_max, y_max) with exclusive upper bounds that
+    contains all cells changed since the last call to clear_dirty(), or
+    None if nothing has changed.
+
+    update() must be passed the body as its first argument after the
+    inputs, which determines the size of the arrays.
+    """
+    def __init__(self, update_callback, inputs=(), time_quantum=None, workers=None):
+        super().__init__(
+            update_callback,
+            inputs=inputs,
+            time_quantum=time_quantum,
+            workers=workers,
+        )
+        self.chars = None
+        self.colors = None
+        self.content = ArrayContent(self)
+        self.dirty = None
+        self.height = 0
+        self.mask = None
+        self.width = 0
+        self._drawn = None
+
+    def _resize(self, width, height):
+        self.chars = np.full((width, height), " ", dtype="<U1")
+        self.colors = np.zeros((width, height), dtype=np.int16)
+        self.height = height
+        self.mask = np.zeros((width, height), dtype=bool)
+        self.width = width
+        self.dirty = (0, 0, width, height)
+        self._drawn = None
+
+    def clear_dirty(self):
+        self.dirty = None
+
+    def draw(self, x, y, char, color):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.chars[x, y] = char
+            self.colors[x, y] = color
+            self.mask[x, y] = True
+            self._drawn = union_rect(self._drawn, (x, y, x + 1, y + 1))
+
+    def draw_many(self, xs, ys, char, colors):
+        xs = np.asarray(xs, dtype=np.intp)
+        ys = np.asarray(ys, dtype=np.intp)
+        colors = np.broadcast_to(colors, xs.shape)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        if not inside.all():
+            xs, ys, colors = xs[inside], ys[inside], colors[inside]
+        if not len(xs):
+            return
+        self.chars[xs, ys] = char
+        self.colors[xs, ys] = colors
+        self.mask[xs, ys] = True
+        self._drawn = union_rect(
+            self._drawn,
+            (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1),
+        )
+
+    def render(self, body, *args, **kwargs):
+        scratch = ArrayLayer(self.update_callback)
+        scratch._resize(body.width, body.height)
+        self.update_callback(scratch, body, *args, **kwargs)
+        return scratch
+
+    def swap(self, scratch):
+        if scratch.mask.shape == (self.width, self.height):
+            self.dirty = union_rect(union_rect(self.dirty, self._drawn), scratch._drawn)
+        else:
+            self.dirty = (0, 0, scratch.width, scratch.height)
+        self.chars = scratch.chars
+        self.colors = scratch.colors
+        self.height = scratch.height
+        self.mask = scratch.mask
+        self.width = scratch.width
+        self._drawn = scratch._drawn
+        self.version += 1
+
+    def update(self, inputs, body, *args, **kwargs):
+        if not self.needs_update(inputs):
+            return
+        if self.workers is not None:
+            self.workers.submit(self, (body,) + args, kwargs)
+            return
+
+        if (body.width, body.height) != (self.width, self.height):
+            self._resize(body.width, body.height)
+        else:
+            previous = self._drawn
+            if previous is not None:
+                x_min, y_min, x_max, y_max = previous
+                self.mask[x_min:x_max, y_min:y_max] = False
+            self._drawn = None
+            self.dirty = union_rect(self.dirty, previous)
+        self.update_callback(self, body, *args, **kwargs)
+        self.dirty = union_rect(self.dirty, self._drawn)
+        self.version += 1
+
+
+class LayerWorkers:
+    """
+    Computes layers in a pool of background threads. Each update is
+    rendered into a new layer object, which poll() then swaps into the
+    actual layer in a single step, so the previous content keeps being
+    shown until the new content is complete. Results of updates that
+    have been superseded by a newer update of the same layer before
+    finishing are discarded.
+
+    Arguments that have a snapshot() method (such as EarthSatellite)
+    are replaced by their snapshot before being handed to a worker, so
+    workers never share mutable state with the render thread or each
+    other.
+
+    on_ready is called from a worker thread whenever a result is ready
+    to be picked up with poll().
+    """
+    def __init__(self, workers=2, on_ready=None):
+        self.on_ready = on_ready
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="termtrack-layer",
+        )
+        self._finished = []
+        self._generations = {}
+        self._lock = Lock()
+
+    def poll(self):
+        """
+        Swaps finished results into their layers. Returns True if any
+        layer has changed.
+        """
+        with self._lock:
+            finished, self._finished = self._finished, []
+        for layer, result in finished:
+            if isinstance(result, BaseException):
+                raise result
+            layer.swap(result)
+        return bool(finished)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, layer, args, kwargs):
+        args = [arg.snapshot() if hasattr(arg, "snapshot") else arg for arg in args]
+        with self._lock:
+            generation = self._generations.get(layer, 0) + 1
+            self._generations[layer] = generation
+        self._executor.submit(self._render, layer, generation, args, kwargs)
+
+    def _render(self, layer, generation, args, kwargs):
+        try:
+            result = layer.render(*args, **kwargs)
+        except Exception as exc:
+            result = exc
+        with self._lock:
+            if self._generations[layer] != generation:
+                return
+            self._finished.append((layer, result))
+        if self.on_ready is not None:
+            self.on_ready()
+
+
+class Compositor:
+    """
+    Combines layers (given topmost first) into a frame of chars and
+    colors indexed by [x, y].
+
+    Layers that rarely change are flattened into a cached base frame
+    that also records which layer each cell came from. Only the other
+    layers are composited on top of that for every frame, each of them
+    covering a base cell only if it is above the layer that cell came
+    from. The base is rebuilt when one of its layers has changed its
+    content or visibility since the last frame.
+    """
+    def __init__(self, layers, static_layers):
+        self.layers = layers
+        self.static_layers = static_layers
+        self._base = None
+        self._base_key = None
+
+    def _build_base(self, width, height, rect):
+        chars, colors, owners = self._base
+        x_min, y_min, x_max, y_max = rect
+        chars[x_min:x_max, y_min:y_max] = " "
+        colors[x_min:x_max, y_min:y_max] = 1
+        owners[x_min:x_max, y_min:y_max] = len(self.layers)
+        # paint from the bottom up so higher layers win
+        for index in reversed(range(len(self.layers))):
+            layer = self.layers[index]
+            if layer.hidden or layer not in self.static_layers:
+                continue
+            if isinstance(layer, ArrayLayer):
+                if layer.mask is None or layer.mask.shape != (width, height):
+                    continue
+                window = (slice(x_min, x_max), slice(y_min, y_max))
+                mask = layer.mask[window]
+                chars[window][mask] = layer.chars[window][mask]
+                colors[window][mask] = layer.colors[window][mask]
+                owners[window][mask] = index
+            else:
+                for (x, y), (char, color) in layer.content.items():
+                    if x_min <= x < x_max and y_min <= y < y_max:
+                        chars[x, y] = char
+                        colors[x, y] = color
+                        owners[x, y] = index
+
+    def _update_base(self, width, height):
+        key = tuple((layer.version, layer.hidden) for layer in self.static_layers)
+        if self._base is None or self._base[0].shape != (width, height):
+            self._base = (
+                np.empty((width, height), dtype="<U1"),
+                np.empty((width, height), dtype=np.int16),
+                np.empty((width, height), dtype=np.int16),
+            )
+            rect = (0, 0, width, height)
+        elif key == self._base_key:
+            return
+        else:
+            rect = None
+            for layer, (version, hidden) in zip(self.static_layers, self._base_key):
+                if layer.version == version and layer.hidden == hidden:
+                    continue
+                if isinstance(layer, ArrayLayer) and layer.hidden == hidden:
+                    rect = union_rect(rect, layer.dirty)
+                else:
+                    rect = (0, 0, width, height)
+                    break
+        if rect is not None:
+            self._build_base(width, height, rect)
+        self._base_key = key
+
+    def compose(self, width, height):
+        """
+        Returns chars and colors of the current frame.
+        """
+        self._update_base(width, height)
+        for layer in self.static_layers:
+            if isinstance(layer, ArrayLayer):
+                layer.clear_dirty()
+        base_chars, base_colors, base_owners = self._base
+        chars = base_chars.copy()
+        colors = base_colors.copy()
+        owners = base_owners.copy()
+
+        for index in reversed(range(len(self.layers))):
+            layer = self.layers[index]
+            if layer.hidden or layer in self.static_layers:
+                continue
+            if isinstance(layer, ArrayLayer):
+                if layer.mask is None or layer.mask.shape != (width, height):
+                    continue
+                mask = layer.mask & (owners > index)
+                chars[mask] = layer.chars[mask]
+                colors[mask] = layer.colors[mask]
+                owners[mask] = index
+                layer.clear_dirty()
+            else:
+                for (x, y), (char, color) in layer.content.items():
+                    if 0 <= x < width and 0 <= y < height and owners[x, y] > index:
+                        chars[x, y] = char
+                        colors[x, y] = color
+                        owners[x, y] = index
+        return chars, colors
@@ -1,11 +1,16 @@
-from datetime import datetime, timedelta
+from copy import copy
+from datetime import datetime, timedelta, timezone
 from math import asin, atan2, cos, degrees, pi, radians, sin, sqrt
 
+import numpy as np
 from requests import get
 from skyfield.api import EarthSatellite as SkyfieldSatellite, wgs84
+from sgp4.api import jday
+from skyfield.sgp4lib import theta_GMST1982
 
 from . import VERSION_STRING
 from .planets import TIMESCALE
+from .utils.geometry import ecef_to_geodetic, geodetic_to_ecef
 
 
 ALIASES = {
@@ -22,6 +27,8 @@ EARTH_FLATTENING_COEFFICIENT = 0.003352891869237217
 EARTH_RADIUS = 6378135
 EARTH_SGP = 3.986004418e+14  # Standard gravitational parameter
 KEPLER_ACCURACY = 1e-6
+PASS_REFINE_ITERATIONS = 16
+PASS_SEARCH_STEP = 60  # seconds
 
 
 def earth_radius_at_latitude(latitude):
@@ -43,6 +50,22 @@ def epoch(yy, days):
     return datetime(year, 1, 1) + timedelta(days=float(days)-1)
 
 
+def julian_date(time):
+    """
+    Returns the UTC Julian date of the given datetime split into whole
+    and fractional days, as expected by SGP4.
+    """
+    time = time.astimezone(timezone.utc)
+    return jday(
+        time.year,
+        time.month,
+        time.day,
+        time.hour,
+        time.minute,
+        time.second + time.microsecond / 1e6,
+    )
+
+
 def keplers_equation(mean_anomaly, eccentricity):
     eccentric_anomaly = mean_anomaly
     while True:
@@ -53,6 +76,18 @@ def keplers_equation(mean_anomaly, eccentricity):
     return eccentric_anomaly
 
 
+def read_tle_file(tle_file):
+    """
+    Returns a list of [name, line1, line2] for all satellites in the
+    given file.
+    """
+    with open(tle_file) as f:
+        lines = [line for line in f.read().strip().split("\n") if line.strip()]
+    if len(lines) < 3 or len(lines) % 3:
+        raise ValueError(f"Invalid TLE format in {tle_file}: expected groups of 3 lines")
+    return [lines[i:i + 3] for i in range(0, len(lines), 3)]
+
+
 def semi_major_axis(mean_motion):
     return (EARTH_SGP / (mean_motion ** 2)) ** (1/3)
 
@@ -65,6 +100,59 @@ def orbital_velocity(semi_major_axis, altitude, latitude):
     )
 
 
+class PassCache:
+    """
+    Remembers rise and set events of a satellite for an observer, so
+    they don't have to be searched for on every EarthSatellite.compute().
+
+    Events are searched for over twice the lookahead period. As long as
+    queried times stay within the first half of that window, all events
+    up to lookahead after them are already known. Once time moves past
+    that (or is moved back before the window), the window is searched
+    again starting at the queried time.
+    """
+    def __init__(self, satellite, observer, key, lookahead=timedelta(days=1)):
+        self.key = key
+        self.lookahead = lookahead
+        self.observer = observer
+        self.satellite = satellite
+        self._events = []
+        self._window = None
+
+    def next_events(self, time):
+        """
+        Returns the times of the next rise and set within lookahead of
+        the given time, each of which may be None.
+        """
+        if self._window is None or not self._window[0] <= time <= self._window[1] - self.lookahead:
+            self._search(time)
+        rise = None
+        set_ = None
+        for event_time, event_type in self._events:
+            if event_time < time:
+                continue
+            if event_time > time + self.lookahead:
+                break
+            if event_type == 0 and rise is None:
+                rise = event_time
+            elif event_type == 2 and set_ is None:
+                set_ = event_time
+            if rise is not None and set_ is not None:
+                break
+        return rise, set_
+
+    def _search(self, time):
+        end = time + 2 * self.lookahead
+        event_times, event_types = self.satellite.find_events(
+            self.observer,
+            TIMESCALE.from_datetime(time),
+            TIMESCALE.from_datetime(end),
+            altitude_degrees=0.0,
+        )
+        self._events = list(zip(event_times.utc_datetime(), event_types.tolist()))
+        self._window = (time, end)
+
+
 class EarthSatellite:
     def __init__(
         self,
@@ -74,11 +162,12 @@ class EarthSatellite:
         observer_longitude=0,
         observer_elevation=0,
         tle_file=None,
+        tle=None,
     ):
-        if tle_file is not None:
+        if tle is None and tle_file is not None:
             with open(tle_file) as f:
                 tle = f.read().strip().split("\n")
-        elif number is not None:
+        elif tle is None and number is not None:
             number = ALIASES.get(number, number)
             response = get(
                 f"https://celestrak.org/NORAD/elements/gp.php?CATNR={number}&FORMAT=TLE",
@@ -93,12 +182,13 @@ class EarthSatellite:
             tle = response.text.strip().split("\n")
             if tle == ["No TLE found"]:
                 raise ValueError(f"Unable to find TLE for {number}")
-        else:
+        elif tle is None:
             raise ValueError("No SATCAT number or TLE file provided")
 
         if len(tle) < 3:
             raise ValueError(f"Invalid TLE format: expected 3 lines, got {len(tle)}")
         self.name = tle[0].strip()
+        self._tle = (tle[1], tle[2])
         self._satellite = SkyfieldSatellite(tle[1], tle[2], self.name, TIMESCALE)
 
         model = self._satellite.model
@@ -134,9 +224,132 @@ class EarthSatellite:
         self.observer_elevation = observer_elevation
         self.observer_latitude = observer_latitude
         self.observer_longitude = observer_longitude
+        self._passes = None
 
         self.compute(time)
 
+    def track(self, start, step, count):
+        """
+        Propagates count positions starting at the given time, step
+        seconds apart, in a single call. Returns arrays of latitudes,
+        longitudes (both in degrees), altitudes (in meters) and an
+        array of shape (3, count) with Earth-fixed x, y, z coordinates
+        in meters. Unlike compute(), this does not touch any attributes
+        and skips apsides and observer data.
+
+        Positions are rotated from the TEME frame used by SGP4 into the
+        Earth-fixed frame using sidereal time only (treating UTC as
+        UT1), skipping nutation and polar motion. This is much cheaper
+        than computing full ITRS positions for every sample and differs
+        from them by less than a map cell could ever show.
+        """
+        jd, fraction = julian_date(start)
+        ecef = self._ecef(jd, fraction + np.arange(count) * (step / 86400))
+        return (*ecef_to_geodetic(*ecef), ecef)
+
+    def passes(self, start, end, latitude, longitude, elevation=0):
+        """
+        Returns a list of (rise, culmination, maximum elevation in
+        degrees, set) for all passes over the given observer location
+        that begin and end between start and end.
+
+        Elevations are sampled at a fixed interval (short enough not to
+        miss passes of a few minutes), and only the intervals around
+        horizon crossings and culminations are refined by bisection, all
+        of them at once. Passes in progress at start or end are omitted.
+        """
+        jd, start_fraction = julian_date(start)
+        step = min(PASS_SEARCH_STEP, self.orbital_period.total_seconds() / 40) / 86400
+        count = int((end - start).total_seconds() / 86400 / step) + 1
+
+        observer = np.array(geodetic_to_ecef(latitude, longitude, elevation))
+        up = np.array((
+            cos(radians(latitude)) * cos(radians(longitude)),
+            cos(radians(latitude)) * sin(radians(longitude)),
+            sin(radians(latitude)),
+        ))
+
+        def elevation_at(fractions):
+            offsets = self._ecef(jd, fractions) - observer[:, None]
+            return np.degrees(np.arcsin(up @ offsets / np.linalg.norm(offsets, axis=0)))
+
+        fractions = start_fraction + np.arange(count) * step
+        above = elevation_at(fractions) > 0
+        crossings = np.flatnonzero(above[1:] != above[:-1])
+        if len(crossings) and above[crossings[0]]:
+            # already above the horizon at start
+            crossings = crossings[1:]
+        if len(crossings) % 2:
+            # still above the horizon at end
+            crossings = crossings[:-1]
+
+        # bisect between the samples around each crossing
+        lower = fractions[crossings]
+        upper = fractions[crossings + 1]
+        rising = np.arange(len(crossings)) % 2 == 0
+        for i in range(PASS_REFINE_ITERATIONS):
+            middle = (lower + upper) / 2
+            crossed = (elevation_at(middle) > 0) == rising
+            upper = np.where(crossed, middle, upper)
+            lower = np.where(crossed, lower, middle)
+        rises = ((lower + upper) / 2)[0::2]
+        sets = ((lower + upper) / 2)[1::2]
+
+        # ternary search for the highest elevation during each pass
+        lower = rises
+        upper = sets
+        for i in range(PASS_REFINE_ITERATIONS + 4):
+            third = (upper - lower) / 3
+            elevations = elevation_at(np.concatenate((lower + third, upper - third)))
+            first_higher = elevations[:len(rises)] > elevations[len(rises):]
+            upper = np.where(first_higher, upper - third, upper)
+            lower = np.where(first_higher, lower, lower + third)
+        culminations = (lower + upper) / 2
+        max_elevations = elevation_at(culminations) if len(culminations) else culminations
+
+        def to_datetime(fraction):
+            return start + timedelta(days=fraction - start_fraction)
+
+        return [
+            (to_datetime(rise), to_datetime(culmination), max_elevation, to_datetime(set_))
+            for rise, culmination, max_elevation, set_ in zip(
+                rises.tolist(),
+                culminations.tolist(),
+                max_elevations.tolist(),
+                sets.tolist(),
+            )
+        ]
+
+    def _ecef(self, jd, fractions):
+        """
+        Returns Earth-fixed positions in meters as an array of shape
+        (3, len(fractions)) for the given UTC Julian date and fractions
+        of days added to it (see track()).
+        """
+        errors, teme, velocities = self._satellite.model.sgp4_array(
+            np.full(len(fractions), jd),
+            fractions,
+        )
+        theta, theta_dot = theta_GMST1982(jd, fractions)
+        cos_theta = np.cos(theta)
+        sin_theta = np.sin(theta)
+        teme = teme.T * 1000  # km to m
+        return np.array((
+            cos_theta * teme[0] + sin_theta * teme[1],
+            cos_theta * teme[1] - sin_theta * teme[0],
+            teme[2],
+        ))
+
+    def snapshot(self):
+        """
+        Returns a copy of this satellite that can be computed
+        independently, e.g. in another thread.
+        """
+        satellite = copy(self)
+        satellite._passes = None
+        satellite._satellite = SkyfieldSatellite(*self._tle, self.name, TIMESCALE)
+        return satellite
+
     def compute(self, time, plus_seconds=0):
         target_time = time + timedelta(seconds=plus_seconds)
         time = TIMESCALE.from_datetime(target_time)
@@ -197,21 +410,8 @@ class EarthSatellite:
             self.observer_azimuth = az.radians
             self.observer_altitude = alt.radians
 
-            self.acquisition_of_signal = None
-            self.loss_of_signal = None
-
-            one_day_ahead = TIMESCALE.utc(
-                target_time.year, target_time.month, target_time.day,
-                target_time.hour + 24, target_time.minute, target_time.second,
-            )
-
-            for event_time, event_type in zip(*self._satellite.find_events(
-                observer,
-                time,
-                one_day_ahead,
-                altitude_degrees=0.0,
-            )):
-                if event_type == 0 and self.acquisition_of_signal is None:  # rise
-                    self.acquisition_of_signal = event_time.utc_datetime()
-                elif event_type == 2 and self.loss_of_signal is None:  # set
-                    self.loss_of_signal = event_time.utc_datetime()
+            pass_key = (self.observer_latitude, self.observer_longitude, self.observer_elevation)
+            if self._passes is None or self._passes.key != pass_key:
+                self._passes = PassCache(self._satellite, observer, pass_key)
+            self.acquisition_of_signal, self.loss_of_signal = \
+                self._passes.next_events(target_time)
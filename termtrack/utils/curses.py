@@ -3,6 +3,8 @@ from queue import Queue
 from threading import Event, Lock
 from time import sleep
 
+import numpy as np
+
 from .geometry import point_distance
 
 
@@ -23,6 +25,11 @@ INPUT_TOGGLE_NIGHT = 14
 INPUT_TOGGLE_ORBIT_APSIDES = 15
 INPUT_TOGGLE_ORBIT_ASCDESC = 16
 INPUT_TOGGLE_TOPO = 17
+INPUT_MAP_READY = 18  # not bound to a key, sent by the map builder
+INPUT_LAYER_READY = 19  # not bound to a key, sent by layer workers
+
+# curses attributes for each color number, filled in by setup()
+COLOR_ATTRS = []
 
 KEYMAP = {
     "a": INPUT_TOGGLE_ORBIT_APSIDES,
@@ -299,7 +306,13 @@ RGB_256 = (
     ((217, 217, 217), 253),
     ((225, 225, 225), 254),
 )
-RGB_CACHE = {}
+RGB_256_ARRAY = np.array([rgb for rgb, color in RGB_256], dtype=np.int16)
+RGB_256_COLORS = np.array([color for rgb, color in RGB_256], dtype=np.uint8)
+RGB_LUT_BITS = 6  # per channel, for a total of 64³ entries
+RGB_LUT_SHIFT = 8 - RGB_LUT_BITS
+
+_palette_index = None
+_rgb_lut = None
 
 
 def bresenham(points, width, height, connect_ends=False):
@@ -378,18 +391,162 @@ def bresenham(points, width, height, connect_ends=False):
         yield point_wrap(point[0], point[1], width, height)
 
 
-def closest_color(r, g, b):
-    if (r, g, b) in RGB_CACHE.keys():
-        return RGB_CACHE[(r, g, b)]
-    best_candidate = 0
-    best_distance = 765
-    for rgb, candidate in RGB_256:
-        distance = abs(r - rgb[0]) + abs(g - rgb[1]) + abs(b - rgb[2])
-        if distance < best_distance:
-            best_candidate = candidate
-            best_distance = distance
-    RGB_CACHE[(r, g, b)] = best_candidate
-    return best_candidate
+def closest_color(r, g, b, exact=False):
+    """
+    Returns the color number closest to the given RGB values (integer
+    or float between 0 and 255). Unless exact is True, the result is
+    looked up in a table of quantized colors.
+    """
+    if exact:
+        return palette_index().closest(r, g, b)
+    return int(rgb_lut()[
+        int(r) >> RGB_LUT_SHIFT,
+        int(g) >> RGB_LUT_SHIFT,
+        int(b) >> RGB_LUT_SHIFT,
+    ])
+
+
+def closest_colors(rgb, exact=False):
+    """
+    Batch version of closest_color() for an array of shape (..., 3),
+    returning an array of color numbers of the leading shape.
+    """
+    if exact:
+        return palette_index().closest_array(rgb)
+    indices = np.asarray(rgb).astype(np.intp) >> RGB_LUT_SHIFT
+    return rgb_lut()[indices[..., 0], indices[..., 1], indices[..., 2]]
+
+
+def palette_index():
+    global _palette_index
+    if _palette_index is None:
+        _palette_index = PaletteIndex()
+    return _palette_index
+
+
+def rgb_lut():
+    """
+    Returns a lookup table mapping RGB values quantized to RGB_LUT_BITS
+    per channel to the color with the smallest Manhattan distance to
+    the center of each quantization bucket. The table is computed on
+    first use and never grows.
+    """
+    global _rgb_lut
+    if _rgb_lut is None:
+        size = 1 << RGB_LUT_BITS
+        # work in units of half a step so the bucket centers are integers
+        centers = np.arange(size, dtype=np.int16) * (2 << RGB_LUT_SHIFT) + \
+            (1 << RGB_LUT_SHIFT) - 1
+        best_distance = np.full((size, size, size), np.iinfo(np.int16).max, dtype=np.int16)
+        distance = np.empty((size, size, size), dtype=np.int16)
+        closer = np.empty((size, size, size), dtype=bool)
+        lut = np.zeros((size, size, size), dtype=np.uint8)
+        # Manhattan distance is the sum of per-channel distances, so
+        # we can compute it for the whole table one candidate at a time
+        for (cr, cg, cb), candidate in RGB_256:
+            np.add(
+                np.abs(centers - 2 * cr)[:, None, None],
+                np.abs(centers - 2 * cg)[None, :, None],
+                out=distance,
+            )
+            distance += np.abs(centers - 2 * cb)[None, None, :]
+            np.less(distance, best_distance, out=closer)
+            np.copyto(best_distance, distance, where=closer)
+            lut[closer] = candidate
+        _rgb_lut = lut
+    return _rgb_lut
+
+
+class PaletteIndex:
+    """
+    Divides the RGB cube into cells and remembers for each cell which
+    palette entries can possibly be closest (by Manhattan distance) to
+    any color within it. Exact queries then only have to look at those
+    few candidates instead of the whole palette. Candidates are kept in
+    palette order, so ties are resolved just like in a linear scan.
+    """
+    def __init__(self, palette=RGB_256, cell_bits=4):
+        self.cell_shift = 8 - cell_bits
+        cells = 1 << cell_bits
+        cell_size = 1 << self.cell_shift
+        self.palette_rgb = np.array([rgb for rgb, color in palette], dtype=np.float64)
+        self.palette_colors = np.array([color for rgb, color in palette], dtype=np.uint8)
+
+        lower = np.arange(cells) * cell_size
+        upper = lower + cell_size
+        # per channel: distance from each cell to each candidate...
+        channel_min = np.maximum(
+            0,
+            np.maximum(
+                lower[:, None] - self.palette_rgb[None, :, :].transpose(2, 0, 1),
+                self.palette_rgb[None, :, :].transpose(2, 0, 1) - upper[:, None],
+            ),
+        )
+        # ...and from the farthest point within the cell
+        channel_max = np.maximum(
+            np.abs(lower[:, None] - self.palette_rgb[None, :, :].transpose(2, 0, 1)),
+            np.abs(upper[:, None] - self.palette_rgb[None, :, :].transpose(2, 0, 1)),
+        )
+        # shapes are now (channel, cell, candidate)
+        min_distance = (
+            channel_min[0][:, None, None, :] +
+            channel_min[1][None, :, None, :] +
+            channel_min[2][None, None, :, :]
+        )
+        max_distance = (
+            channel_max[0][:, None, None, :] +
+            channel_max[1][None, :, None, :] +
+            channel_max[2][None, None, :, :]
+        )
+        # a candidate that is farther from the whole cell than another
+        # candidate is from any point in it can never win
+        possible = min_distance <= max_distance.min(axis=3, keepdims=True)
+        self.candidates = {}
+        for cell in zip(*np.nonzero(possible.any(axis=3))):
+            indices = np.flatnonzero(possible[cell])
+            self.candidates[tuple(int(i) for i in cell)] = (
+                indices,
+                [(tuple(self.palette_rgb[i]), int(self.palette_colors[i])) for i in indices],
+            )
+
+    def _cell(self, value):
+        return min(int(value) >> self.cell_shift, (256 >> self.cell_shift) - 1)
+
+    def closest(self, r, g, b):
+        best_candidate = 0
+        best_distance = 765
+        for rgb, candidate in self.candidates[
+            (self._cell(r), self._cell(g), self._cell(b))
+        ][1]:
+            distance = abs(r - rgb[0]) + abs(g - rgb[1]) + abs(b - rgb[2])
+            if distance < best_distance:
+                best_candidate = candidate
+                best_distance = distance
+        return best_candidate
+
+    def closest_array(self, rgb):
+        rgb = np.asarray(rgb)
+        flat_rgb = rgb.reshape(-1, 3).astype(np.float64)
+        colors = np.zeros(len(flat_rgb), dtype=np.uint8)
+        cells_per_axis = 256 >> self.cell_shift
+        cells = np.minimum(flat_rgb.astype(np.intp) >> self.cell_shift, cells_per_axis - 1)
+        cell_ids = (cells[:, 0] * cells_per_axis + cells[:, 1]) * cells_per_axis + cells[:, 2]
+        by_cell = np.argsort(cell_ids, kind='stable')
+        cell_ids, counts = np.unique(cell_ids[by_cell], return_counts=True)
+        for cell_id, members in zip(cell_ids, np.split(by_cell, np.cumsum(counts)[:-1])):
+            cell_id = int(cell_id)
+            indices = self.candidates[(
+                cell_id // cells_per_axis ** 2,
+                cell_id // cells_per_axis % cells_per_axis,
+                cell_id % cells_per_axis,
+            )][0]
+            distances = np.abs(
+                flat_rgb[members, None, :] - self.palette_rgb[None, indices, :]
+            ).sum(axis=2)
+            # argmin() picks the first of several equally close
+            # candidates, just like closest()
+            colors[members] = self.palette_colors[indices[distances.argmin(axis=1)]]
+        return colors.reshape(rgb.shape[:-1])
 
 
 def fill_outline(center, outline_points, width, height):
@@ -402,6 +559,61 @@ def fill_outline(center, outline_points, width, height):
                 queue.append(next_pixel)
 
 
+class FrameWriter:
+    """
+    Writes frames given as chars and colors indexed by [x, y] to a
+    curses window. The previous frame is kept around so only cells
+    that have changed since then are written. Consecutive changed cells
+    of the same color within a row are written with a single call.
+    """
+    def __init__(self, window):
+        self.window = window
+        self._chars = None
+        self._colors = None
+
+    def write(self, chars, colors):
+        """
+        Returns the number of cells written.
+        """
+        width, height = chars.shape
+        if self._chars is None or self._chars.shape != chars.shape:
+            self.window.erase()
+            changed = np.ones(chars.shape, dtype=bool)
+        else:
+            changed = (chars != self._chars) | (colors != self._colors)
+        self._chars = chars
+        self._colors = colors
+
+        # work on rows rather than columns from here on
+        positions = np.flatnonzero(changed.T)
+        if not len(positions):
+            return 0
+        run_colors = colors.T.ravel()[positions]
+        run_starts = np.flatnonzero(
+            (np.diff(positions) != 1) |
+            (np.diff(run_colors) != 0) |
+            (positions[1:] % width == 0)
+        ) + 1
+        text = "".join(chars.T.ravel()[positions].tolist())
+
+        for start, end, position, color in zip(
+            [0] + run_starts.tolist(),
+            run_starts.tolist() + [len(positions)],
+            positions[np.concatenate(([0], run_starts))].tolist(),
+            run_colors[np.concatenate(([0], run_starts))].tolist(),
+        ):
+            y, x = divmod(position, width)
+            if x + end - start == width:
+                # addstr() would fail trying to move the cursor past
+                # the bottom right corner, insstr() doesn't move it
+                # and only pushes the old content of this run out of
+                # the window
+                self.window.insstr(y, x, text[start:end], COLOR_ATTRS[color])
+            else:
+                self.window.addstr(y, x, text[start:end], COLOR_ATTRS[color])
+        return len(positions)
+
+
 def get_adjacent(x, y, width, height):
     """
     Returns a list of tuples with coordinates adjacent to x, y.
@@ -458,6 +670,7 @@ def setup(stdscr):
     curses.use_default_colors()
     for i in range(0, curses.COLORS):
         curses.init_pair(i + 1, i, -1)
+    COLOR_ATTRS[:] = [curses.color_pair(i) for i in range(max(curses.COLORS, 256) + 1)]
     curses.curs_set(False)
     stdscr.timeout(0)
 
@@ -1,5 +1,7 @@
 from math import acos, atan2, cos, degrees, radians, sin, sqrt
 
+import numpy as np
+
 
 def cartesian_to_latlon(x, y, z):
     return spherical_to_latlon(*cartesian_to_spherical(x, y, z))
@@ -9,6 +11,41 @@ def cartesian_to_spherical(x, y, z):
     return acos(z), atan2(y, x)
 
 
+def ecef_to_geodetic(x, y, z, radius=6378137.0, flattening=1 / 298.257223563):
+    """
+    Converts arrays of Earth-fixed coordinates in meters to geodetic
+    latitudes, longitudes (both in degrees) and altitudes (in meters)
+    on the WGS84 ellipsoid.
+    """
+    e2 = flattening * (2 - flattening)
+    r = np.sqrt(x * x + y * y)
+    lat = np.arctan2(z, r)
+    for iteration in range(3):
+        sin_lat = np.sin(lat)
+        radius_of_curvature = radius / np.sqrt(1 - e2 * sin_lat * sin_lat)
+        lat = np.arctan2(z + radius_of_curvature * e2 * sin_lat, r)
+    sin_lat = np.sin(lat)
+    radius_of_curvature = radius / np.sqrt(1 - e2 * sin_lat * sin_lat)
+    altitude = np.hypot(r, z + radius_of_curvature * e2 * sin_lat) - radius_of_curvature
+    return np.degrees(lat), np.degrees(np.arctan2(y, x)), altitude
+
+
+def geodetic_to_ecef(lat, lon, altitude, radius=6378137.0, flattening=1 / 298.257223563):
+    """
+    Inverse of ecef_to_geodetic().
+    """
+    e2 = flattening * (2 - flattening)
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    sin_lat = np.sin(lat)
+    radius_of_curvature = radius / np.sqrt(1 - e2 * sin_lat * sin_lat)
+    return (
+        (radius_of_curvature + altitude) * np.cos(lat) * np.cos(lon),
+        (radius_of_curvature + altitude) * np.cos(lat) * np.sin(lon),
+        (radius_of_curvature * (1 - e2) + altitude) * sin_lat,
+    )
+
+
 def latlon_to_cartesian(lat, lon):
     return spherical_to_cartesian(*latlon_to_spherical(lat, lon))
 
@@ -17,6 +54,13 @@ def latlon_to_spherical(lat, lon):
     return -radians(lat) + radians(90), radians(lon)
 
 
+def latlon_to_spherical_array(lat, lon):
+    """
+    Same as latlon_to_spherical(), but for NumPy arrays.
+    """
+    return -np.radians(lat) + radians(90), np.radians(lon)
+
+
 def point_distance(point1, point2):
     return sqrt(abs((point2[0] - point1[0]) ** 2 - (point2[1] - point1[1]) ** 2))
 
@@ -45,5 +89,13 @@ def spherical_to_cartesian(theta, phi):
     return x, y, z
 
 
+def spherical_to_cartesian_array(theta, phi):
+    """
+    Same as spherical_to_cartesian(), but for NumPy arrays.
+    """
+    sin_theta = np.sin(theta)
+    return sin_theta * np.cos(phi), sin_theta * np.sin(phi), np.cos(theta)
+
+
 def spherical_to_latlon(theta, phi):
     return degrees(radians(90) - theta), degrees(phi)
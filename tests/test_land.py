@@ -0,0 +1,51 @@
+from os.path import dirname, join
+
+import pytest
+import shapefile
+
+from termtrack.body import Earth, rasterize_land
+from termtrack.utils.geometry import point_in_poly
+
+
+def per_pixel_land(width, height):
+    """
+    Land mask computed the way termtrack originally did it: every
+    pixel is tested against every shape whose bounding box contains it.
+    """
+    reader = shapefile.Reader(join(dirname(__file__), "..", "termtrack", "data", Earth.SHAPEFILE))
+    try:
+        shapes = [(shape.bbox, shape.points) for shape in reader.iterShapes()]
+    finally:
+        reader.close()
+    land = []
+    for x in range(width):
+        column = []
+        for y in range(height):
+            lat = 90 - y / (height - 1) * 180
+            lon = x / (width - 1) * 360 - 180
+            column.append(any(
+                lat > bbox[1] and
+                lat < bbox[3] and
+                lon > bbox[0] and
+                lon < bbox[2] and
+                point_in_poly(lon, lat, points)
+                for bbox, points in shapes
+            ))
+        land.append(column)
+    return land
+
+
+@pytest.mark.parametrize("width, height", [(33, 17), (80, 24), (157, 43), (200, 60)])
+def test_rasterize_land_matches_per_pixel(width, height):
+    assert rasterize_land(Earth.SHAPEFILE, width, height).tolist() == \
+        per_pixel_land(width, height)
+
+
+def test_rasterize_land_stripes():
+    width, height = 157, 43
+    full = rasterize_land(Earth.SHAPEFILE, width, height)
+    for x_start, x_end in ((0, 40), (40, 100), (100, 157)):
+        assert (
+            rasterize_land(Earth.SHAPEFILE, width, height, x_start, x_end) ==
+            full[x_start:x_end]
+        ).all()
@@ -0,0 +1,40 @@
+import numpy as np
+
+from termtrack.utils.curses import RGB_256, closest_color, closest_colors
+
+
+def linear_closest_color(r, g, b):
+    """
+    The original closest_color(): a linear scan over the whole palette.
+    """
+    best_candidate = 0
+    best_distance = 765
+    for rgb, candidate in RGB_256:
+        distance = abs(r - rgb[0]) + abs(g - rgb[1]) + abs(b - rgb[2])
+        if distance < best_distance:
+            best_candidate = candidate
+            best_distance = distance
+    return best_candidate
+
+
+def sample_colors():
+    random = np.random.default_rng(0)
+    return np.concatenate((
+        np.array([rgb for rgb, color in RGB_256], dtype=np.float64),
+        random.integers(0, 256, size=(3000, 3)).astype(np.float64),
+        random.uniform(0, 255, size=(3000, 3)),
+    ))
+
+
+def test_closest_color_exact():
+    for r, g, b in sample_colors().tolist():
+        assert closest_color(r, g, b, exact=True) == linear_closest_color(r, g, b)
+
+
+def test_closest_colors_exact():
+    colors = sample_colors()
+    expected = [linear_closest_color(r, g, b) for r, g, b in colors.tolist()]
+    assert closest_colors(colors, exact=True).tolist() == expected
+    # leading dimensions are preserved
+    assert closest_colors(colors[:6000].reshape(-1, 2, 3), exact=True).reshape(-1).tolist() == \
+        expected[:6000]